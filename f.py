@@ -9,8 +9,13 @@ and then noted in the .qc file.
 
 See the README for more information. A function template is provided
 here for use.
+
+A function may also define table(X) which takes a NumPy array with
+one row of 0/1 bits per input and returns f for every row at once.
 """
 
+import numpy as np
+
 class f:
   def __init__(self, *args):
     pass
@@ -35,6 +40,11 @@ class grover:
   def __call__(self, x):
     return 1 if x in self.xstar else 0
 
+  def table(self, X):
+    n = X.shape[1]
+    index = X.astype(np.int64) @ (1 << np.arange(n-1, -1, -1))
+    return np.isin(index, [int(x, 2) for x in self.xstar if len(x) == n])
+
 
 class vecf:
   """
@@ -58,4 +68,10 @@ class vecf:
     ex1 = (X[0] + X[1] + X[2])
     return ((X[0]+X[1])**ex1 + (X[1]+X[2])**ex1)%2
     # exponent = sum(self.a[i]*X[i] for i in range(len(x))) % self.k
-    # return int((1/2)*(1 + (-1)**exponent))
\ No newline at end of file
+    # return int((1/2)*(1 + (-1)**exponent))
+
+  def table(self, X):
+    """ same as __call__ for every row of X at once """
+    X = X.astype(np.int64)
+    ex1 = X[:, 0] + X[:, 1] + X[:, 2]
+    return ((X[:, 0]+X[:, 1])**ex1 + (X[:, 1]+X[:, 2])**ex1) % 2
\ No newline at end of file
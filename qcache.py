@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+Caches used to avoid rebuilding the same parts of a circuit.
+
+lrucache holds constructed layers in memory keyed by a signature of
+the layer, evicting the least recently used ones once the memory
+budget is used up.
+
+diskcache keeps compiled circuits (the optimized gates with their
+matrices, Uf permutations, phases and everything needed to run them) in .npz
+files so a repeat run of an unchanged circuit skips compilation.
+"""
+
+import os
+import json
+import time
+from hashlib import sha256
+from collections import OrderedDict
+from numpy import array, load, savez
+
+from qengine import gate
+
+
+class lrucache:
+    """
+    Least recently used cache with a memory budget in bytes.
+
+    Each entry is stored with its size, entries are evicted oldest
+    use first until the total fits in the budget. Hits, misses and
+    evictions are counted.
+
+    sizeof - optional function measuring an entry, for values which
+             grow after they are stored (such as gates building their
+             matrices on first use). Sizes are then measured again
+             before each insertion (and eviction) and when reported.
+    """
+    def __init__(self, budget=256 * 2**20, sizeof=None):
+        self.budget = budget
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        self.measure()
+        return "{} hits, {} misses, {} evictions, {} entries using {:.1f} MB".format(
+            self.hits, self.misses, self.evictions, len(self.entries), self.size / 2**20)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ returns the value stored for key or None (a miss) """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def measure(self):
+        """ measures the entries again with sizeof (if given) """
+        if self.sizeof is None:
+            return
+        for key, (value, _) in self.entries.items():
+            self.entries[key] = (value, self.sizeof(value))
+        self.size = sum(size for _, size in self.entries.values())
+
+    def put(self, key, value, size=None):
+        """
+        stores value for key (of size bytes, or sizeof(value)), evicting
+        old entries to fit the budget
+        """
+        if size is None:
+            size = self.sizeof(value)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.measure()
+        if size > self.budget:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, old) = self.entries.popitem(last=False)
+            self.size -= old
+            self.evictions += 1
+
+
+class diskcache:
+    """
+    Directory of compiled circuits stored as .npz files.
+
+    Entries older than max_age seconds are dropped, and the least
+    recently used entries are removed once the directory holds more
+    than max_bytes.
+    """
+    def __init__(self, path, max_bytes=512 * 2**20, max_age=7 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @staticmethod
+    def key(*parts):
+        """ hash of the given strings / bytes (file contents, arguments) """
+        h = sha256()
+        for part in parts:
+            h.update(part if isinstance(part, bytes) else str(part).encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def load(self, key):
+        """
+        Returns (info, circuit) saved for key or None. info is the dict
+        given to save, circuit the list of layers of gates.
+        """
+        name = self.file(key)
+        if not os.path.exists(name):
+            return None
+        if time.time() - os.path.getmtime(name) > self.max_age:
+            os.remove(name)
+            return None
+        try:
+            with load(name) as data:
+                info = json.loads(str(data["info"]))
+                circuit = [[gate(g["name"], g["targets"], g["controls"],
+                                 data[g["matrix"]] if g["matrix"] else None,
+                                 data[g["perm"]] if g["perm"] else None,
+                                 data[g["diag"]] if g.get("diag") else None)
+                            for g in layer] for layer in info.pop("circuit")]
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(name)                  # mark as recently used
+        return info, circuit
+
+    def save(self, key, info, circuit):
+        """
+        Saves the circuit (layers of gates) with the JSON-able info
+        dict for key, then trims the cache to its limits.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        arrays = dict()
+        layers = list()
+        for layer in circuit:
+            layers.append(list())
+            for g in layer:
+                entry = {"name": g.name, "targets": list(g.targets), "controls": list(g.controls),
+                         "matrix": None, "perm": None, "diag": None}
+                if g._matrix is not None:
+                    entry["matrix"] = f"m{len(arrays)}"
+                    arrays[entry["matrix"]] = g._matrix
+                if g.perm is not None:
+                    entry["perm"] = f"p{len(arrays)}"
+                    arrays[entry["perm"]] = g.perm
+                if g.diag is not None:
+                    entry["diag"] = f"d{len(arrays)}"
+                    arrays[entry["diag"]] = g.diag
+                layers[-1].append(entry)
+        info = dict(info, circuit=layers)
+
+        # write to a temporary file first so readers never see half a file
+        temp = self.file(key) + f".{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            savez(f, info=array(json.dumps(info)), **arrays)
+        os.replace(temp, self.file(key))
+        self.trim()
+
+    def trim(self):
+        """ removes expired entries, then the least recently used ones """
+        entries = list()
+        for name in os.listdir(self.path):
+            if not name.endswith(".npz"):
+                continue
+            name = os.path.join(self.path, name)
+            stat = os.stat(name)
+            if time.time() - stat.st_mtime > self.max_age:
+                os.remove(name)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(name)
+            total -= size
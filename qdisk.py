@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Out of core statevector stored in a numpy.memmap file on disk.
+
+Only one block of 2^b amplitudes is held in memory at a time. A pass
+streams every block of the file through memory once, in file order,
+and applies a group of gates to it. The block of a pass is made of the
+qbits its gates touch (the "resident" qbits) topped up with the lowest
+qbits, so it is read as a few long contiguous runs of the file.
+
+Gates are grouped into as few passes as possible: each pass takes
+every remaining gate which fits in the block, moving gates ahead of
+earlier ones when they act on different qbits (so they commute).
+
+SWAP gates move no data: they swap the qbits the later gates are
+placed on (where), and measurements map the basis states of the file
+back to qbit order as they read it.
+
+Measurements are also computed a block at a time, so runs whose
+statevector doesn't fit in RAM only need disk space.
+"""
+
+import os
+import tempfile
+import re
+from numpy import memmap, array, ascontiguousarray, arange, argpartition, argsort, bincount, concatenate, lexsort, flatnonzero, float64, int64
+from numpy.linalg import norm
+from numpy.random import default_rng
+
+from qengine import apply
+from qstate import qstate
+
+
+def plan(circuit, b):
+    """
+    Groups the gates of the circuit (layers of gates) into passes of
+    at most b resident qbits. Returns a list of (qbits, gates) passes,
+    applying them in order gives the same state as the circuit.
+    """
+    remaining = [g for layer in circuit for g in layer if g.name != "I"]
+    passes = list()
+    while remaining:
+        qbits, gates, blocked, rest = set(), list(), set(), list()
+        for g in remaining:
+            q = set(g.qbits)
+            if not q & blocked and (len(qbits | q) <= b or not gates):
+                qbits |= q
+                gates.append(g)
+            else:
+                blocked |= q        # later gates on these must wait
+                rest.append(g)
+        passes.append((qbits, gates))
+        remaining = rest
+    return passes
+
+
+class mstate:
+    """
+    Statevector of n qbits kept in a memmap file (removed on close).
+
+    state - input string as in qstate (product state)
+    block - amplitudes held in memory at once (a power of 2)
+    path  - directory of the file (the temp directory if None)
+    dtype - complex precision of the amplitudes
+    """
+    def __init__(self, state="0", block=2**22, path=None, dtype=complex):
+        qbits = list()
+        for m in re.findall(r"(\[[\d\., ]+\]|[01])", state):
+            if m in ("0", "1"):
+                v = array([m == "0", m == "1"], dtype=dtype)
+            else:
+                v = array([float(a) for a in m[1:-1].split(',')], dtype=dtype)
+            qbits.append(v / norm(v))
+        self.n = len(qbits)
+        self.b = min(self.n, max(1, int(block).bit_length() - 1))
+        self.passes = 0
+        self.where = list(range(self.n))        # qbit -> qbit of the file
+
+        fd, self.file = tempfile.mkstemp(suffix=".state", dir=path)
+        os.close(fd)
+        self.data = memmap(self.file, dtype=dtype, mode="w+", shape=(2**self.n,))
+
+        # write the product state a block at a time
+        low = qstate.tensor(*[qstate(v, norm=False) for v in qbits[self.n-self.b:]]).state \
+            if self.b > 1 else qbits[-1]
+        for i in range(2**(self.n-self.b)):
+            coef = 1
+            for j in range(self.n-self.b):
+                coef *= qbits[j][i >> (self.n-self.b-j-1) & 1]
+            self.data[i << self.b:(i+1) << self.b] = coef * low
+        self.data.flush()
+
+    def __len__(self):
+        return 2**self.n
+
+    def __str__(self):
+        if self.n <= 16:
+            phi = qstate(array(self.data), norm=False)
+            phi.where = self.where[:]
+            return str(phi)
+        return f"statevector of {self.n} qbits in {self.file}"
+
+    @property
+    def bits(self):
+        return self.n
+
+    pure_states = staticmethod(qstate.pure_states)
+
+    def close(self):
+        """ removes the file of the state """
+        self.data.flush()
+        self.data = None
+        os.remove(self.file)
+
+    def run(self, circuit):
+        """ applies the circuit (layers of gates) in as few passes as it can """
+        moved = list()
+        for layer in circuit:
+            for g in layer:
+                if g.name == "SWAP" and not g.controls:
+                    self.swap(*g.targets)
+                else:
+                    moved.append([g.moved(self.where)])
+        for qbits, gates in plan(moved, self.b):
+            self.apply_pass(qbits, gates)
+
+    def apply(self, g):
+        """ applies a single qengine gate (one pass over the file) """
+        if g.name == "SWAP" and not g.controls:
+            self.swap(*g.targets)
+            return
+        g = g.moved(self.where)
+        self.apply_pass(set(g.qbits), [g])
+
+    def swap(self, a, b):
+        """ swaps the qbits a and b by relabelling them (no pass) """
+        self.where[a], self.where[b] = self.where[b], self.where[a]
+
+    def ordered(self, index):
+        """ the basis states of file indices in qbit order """
+        if self.where == list(range(self.n)):
+            return index
+        order = 0
+        for q in range(self.n):
+            order |= (index >> (self.n - self.where[q] - 1) & 1) << (self.n - q - 1)
+        return order
+
+    def apply_pass(self, qbits, gates):
+        """
+        Streams the file through memory once, applying the gates (all
+        on qbits) to each block.
+        """
+        resident = set(qbits)
+        for q in range(self.n-1, -1, -1):
+            if len(resident) >= self.b:
+                break
+            resident.add(q)
+        inner = sorted(resident)
+        outer = [q for q in range(self.n) if q not in resident]
+        axis = {inner[i]: i for i in range(len(inner))}
+        gates = [g.moved(axis) for g in gates]
+
+        tensor = self.data.reshape((2,)*self.n)
+        for i in range(2**len(outer)):
+            index = [slice(None)] * self.n
+            for j in range(len(outer)):
+                index[outer[j]] = i >> (len(outer)-j-1) & 1
+            block = ascontiguousarray(tensor[tuple(index)]).reshape(-1)
+            for g in gates:
+                block = apply(block, g)
+            tensor[tuple(index)] = block.reshape((2,)*len(inner))
+        self.data.flush()
+        self.passes += 1
+
+    def blocks(self):
+        """ the basis index of the first amplitude and |amplitude|^2 of each block """
+        size = 2**self.b
+        for i in range(0, len(self), size):
+            yield i, (abs(self.data[i:i+size])**2).astype(float64, copy=False)
+
+    @property
+    def prob(self):
+        """ probabilities of pure states (all in memory) """
+        p = abs(self.data)**2
+        return p.reshape((2,)*self.n).transpose(self.where).reshape(-1)
+
+    def marginal(self, top):
+        """ probabilities of the pure states of the top 'top' bits """
+        p = 0
+        for i, block in self.blocks():
+            index = self.ordered(i + arange(len(block), dtype=int64)) >> (self.n - top)
+            p = p + bincount(index, weights=block, minlength=2**top)  # sums in float64
+        return p
+
+    def joint_prob(self, pattern):
+        """ probability of a measurement matching the pattern (see qstate) """
+        mask, value = qstate.pattern(pattern, self.n)
+        p = 0.0
+        for i, block in self.blocks():
+            index = self.ordered(i + arange(len(block), dtype=int64))
+            p += block[index & mask == value].sum(dtype=float64)
+        return p
+
+    def sample(self, shots, rng=None):
+        """
+        Draws 'shots' measurements without collapsing the state: first
+        how many shots land in each block, then within the blocks.
+        """
+        rng = default_rng(rng)
+        totals = array([block.sum() for _, block in self.blocks()], dtype=float64)
+        per_block = rng.multinomial(shots, totals / totals.sum())
+        res = dict()
+        for (i, block), k in zip(self.blocks(), per_block):
+            if k:
+                counts = rng.multinomial(k, block / block.sum())
+                for j in flatnonzero(counts):
+                    res[int(self.ordered(i + j))] = int(counts[j])
+        return res
+
+    def top(self, k):
+        """ the k most likely pure states, keeping the best k of each block """
+        index, prob = array([], dtype=int64), array([])
+        for i, block in self.blocks():
+            j = argpartition(block, len(block) - min(k, len(block)))[len(block) - min(k, len(block)):]
+            index = concatenate([index, self.ordered(i + j)])
+            prob = concatenate([prob, block[j]])
+            keep = lexsort((index, -prob))[:k]      # ties go to the lower index
+            index, prob = index[keep], prob[keep]
+        return index, prob
+
+    def above(self, threshold):
+        """ the pure states with probability > threshold """
+        index, prob = list(), list()
+        for i, block in self.blocks():
+            j = flatnonzero(block > threshold)
+            index.append(self.ordered(i + j))
+            prob.append(block[j])
+        index, prob = concatenate(index), concatenate(prob)
+        order = argsort(index, kind="stable")
+        return index[order], prob[order]
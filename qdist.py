@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Statevector split over a group of worker processes.
+
+The 2^n amplitudes live in one multiprocessing.shared_memory block cut
+into N = 2^g slices, one per worker (rank). The top g physical qbits
+are "global": their bits are the rank, so slice r holds the amplitudes
+whose top g bits are r. The other n-g qbits are "local" to each slice.
+
+  - a gate on local qbits is applied by every worker to its own slice
+    in parallel, with no communication (global controls just decide
+    which ranks take part)
+  - a gate on a global qbit first swaps that qbit with a free local
+    one: ranks r and r' differing in that global bit exchange the
+    halves of their slices where the local bit differs. The logical
+    to physical qbit layout is updated instead of swapping back.
+  - a SWAP gate only swaps two entries of that layout
+
+Workers only ever touch their own slice, apart from the pairwise
+exchange, so the exchange step is the one place a multi-node version
+would send messages instead of copying within shared memory.
+
+Gates wider than the local qbits (such as a Uf over every qbit) can't
+be made local and are applied to the whole buffer by the parent.
+"""
+
+import numpy as np
+from math import log
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import qengine
+from qengine import gate, apply
+from qstate import qstate
+
+
+SHM = None              # shared memory block attached in a worker
+SLICES = None           # (2^g, 2^(n-g)) view of it, one row per rank
+
+
+def attach(name, shape, dtype):
+    """ attaches a worker process to the shared statevector """
+    global SHM, SLICES
+    qengine.THREADS = 1             # the workers already fill the cores
+    SHM = SharedMemory(name)
+    SLICES = np.ndarray(shape, dtype=dtype, buffer=SHM.buf)
+
+
+def local_gate(rank, g, bits):
+    """
+    Applies the gate g on physical qbits to the slice of the rank,
+    where the first 'bits' qbits are global. Global controls must be
+    1 in the rank for the gate to act.
+    """
+    for c in g.controls:
+        if c < bits and not rank >> (bits-c-1) & 1:
+            return
+    local = gate(g.name, [t - bits for t in g.targets], [c - bits for c in g.controls if c >= bits],
+                 g._matrix, g.perm, g.diag)
+    apply(SLICES[rank], local)
+
+
+def exchange(rank, partner, bit):
+    """
+    Swaps the global qbit of rank with the local qbit 'bit': rank
+    (global bit 0) gives its amplitudes with the local bit 1 to
+    partner (global bit 1) for those with the local bit 0.
+    """
+    n = int(log(SLICES.shape[1], 2))
+    ours = SLICES[rank].reshape((2,)*n)
+    theirs = SLICES[partner].reshape((2,)*n)
+    one = (slice(None),)*bit + (1,)
+    zero = (slice(None),)*bit + (0,)
+    mine = ours[one].copy()
+    ours[one] = theirs[zero]
+    theirs[zero] = mine
+
+
+class dstate:
+    """
+    Statevector of n qbits shared by 'workers' processes (a power of
+    2), state being an input string as in qstate and dtype the complex
+    precision of the amplitudes. Registers too small for that many
+    slices of 2 amplitudes or more get fewer workers.
+    """
+    def __init__(self, state="0", workers=2, dtype=complex):
+        psi = qstate(state, dtype=dtype).state
+        self.n = int(log(len(psi), 2))
+        self.g = int(log(workers, 2))
+        if 2**self.g != workers:
+            raise ValueError(f"need a power of 2 workers, not {workers}")
+        self.g = min(self.g, self.n - 1)
+        self.where = list(range(self.n))        # logical qbit -> physical qbit
+
+        shape = (2**self.g, 2**(self.n - self.g))
+        self.shm = SharedMemory(create=True, size=psi.nbytes)
+        self.slices = np.ndarray(shape, dtype=psi.dtype, buffer=self.shm.buf)
+        self.slices[...] = psi.reshape(shape)
+        self.pool = Pool(2**self.g, initializer=attach, initargs=(self.shm.name, shape, psi.dtype))
+        self.exchanges = 0
+
+    def __len__(self):
+        return 2**self.n
+
+    def __str__(self):
+        return str(self.gather())
+
+    @property
+    def bits(self):
+        return self.n
+
+    def close(self):
+        """ stops the workers and frees the shared memory """
+        self.pool.close()
+        self.pool.join()
+        self.slices = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def swap(self, a, b):
+        """ swaps the physical qbits a and b (exchanging if one is global) """
+        if a > b:
+            a, b = b, a
+        if a >= self.g:
+            self.pool.starmap(local_gate, [(r, gate("SWAP", [a, b]), self.g) for r in range(2**self.g)])
+        elif b >= self.g:
+            pairs = [(r, r | 1 << (self.g-a-1), b - self.g) for r in range(2**self.g) if not r >> (self.g-a-1) & 1]
+            self.pool.starmap(exchange, pairs)
+            self.exchanges += 1
+        else:
+            # two global qbits go through a free local one
+            l = self.n - 1
+            self.swap(a, l)
+            self.swap(b, l)
+            self.swap(a, l)
+            return
+        i, j = self.where.index(a), self.where.index(b)
+        self.where[i], self.where[j] = b, a
+
+    def apply(self, g):
+        """
+        Applies a qengine gate given on logical qbits, an uncontrolled
+        SWAP just swaps the physical qbits of its logical ones.
+        """
+        if g.name == "I":
+            return
+        if g.name == "SWAP" and not g.controls:
+            a, b = g.targets
+            self.where[a], self.where[b] = self.where[b], self.where[a]
+            return
+        targets = [self.where[t] for t in g.targets]
+        if any(t < self.g for t in targets):
+            free = [p for p in range(self.n-1, self.g-1, -1) if p not in targets]
+            wanted = [t for t in targets if t < self.g]
+            if g.name == "H" and not g.controls and len(free) < len(wanted):
+                for t in g.targets:             # H factors into one gate per qbit
+                    self.apply(gate("H", [t]))
+                return
+            if len(free) < len(wanted):
+                apply(self.slices.reshape(-1), self.physical(g))
+                return
+            for t in wanted:
+                self.swap(t, free.pop(0))
+        self.pool.starmap(local_gate, [(r, self.physical(g), self.g) for r in range(2**self.g)])
+
+    def physical(self, g):
+        """ the gate g moved from logical to physical qbits """
+        return g.moved(self.where)
+
+    def gather(self):
+        """
+        Restores the logical qbit order and returns a qstate over the
+        shared buffer (no copy) to measure.
+        """
+        for q in range(self.n):
+            if self.where[q] != q:
+                self.swap(q, self.where[q])
+        phi = qstate(norm=False)
+        phi._statevector = self.slices.reshape(-1)
+        return phi
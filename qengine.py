@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+"""
+Applies quantum gates directly to statevectors.
+
+Rather than building the full 2^n x 2^n matrix of a layer, the
+statevector is viewed as an n axis tensor (one axis of length 2
+per qbit, q0 being the first axis) and only the small 2^k x 2^k
+matrix of each gate is contracted over the axes of the k qbits it
+acts on. A layer then costs O(2^n * 2^k) instead of O(4^n).
+
+Gates are applied in place: the few temporaries needed live in a
+preallocated work buffer the size of the state, so once it exists a
+simulation allocates no more state sized arrays and peaks at twice
+the size of the state.
+
+Large states are split along axes the gate does not touch into
+independent chunks which are worked on by a pool of THREADS threads
+(NumPy releases the GIL in its loops). Each amplitude goes through
+the same arithmetic either way, so the results are bit-identical.
+"""
+
+import os
+import threading
+from math import log, sqrt
+from concurrent.futures import ThreadPoolExecutor
+from numpy import arange, array, asarray, ascontiguousarray, count_nonzero, diagflat, diagonal, empty, eye, flip, int64, kron, matmul, moveaxis, result_type, take, uint8, zeros
+
+
+THREADS = os.cpu_count() or 1  # threads applying each gate
+CHUNK = 2**16                   # fewest amplitudes worth a thread
+POOL = None
+COLUMNS = 2**16                 # amplitudes a thread transforms at once
+SCRATCH = dict()                # preallocated work buffers by dtype
+LOCAL = threading.local()       # small buffer of each thread
+
+
+# gates which are diagonal (applied by multiplying in their phases)
+DIAGONAL = ("I", "PAULIz")
+
+
+# matrices of the single and two qbit gates available in .qc files
+GATES = {
+    "I": eye(2),
+    "NOT": flip(eye(2), axis=1),
+    "S": flip(eye(2), axis=1),
+    "H": array([[1, 1], [1, -1]]) / sqrt(2),
+    "PAULIz": array([[1, 0], [0, -1]]),
+    "SWAP": array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]]),
+}
+
+
+class gate:
+    """
+    A single quantum gate placed on the qbits of a circuit.
+
+    name     - name of the gate (NOT, H, Uf, ...)
+    targets  - qbits the gate acts on (first target is the top bit)
+    controls - qbits which must all be 1 for the gate to act
+    matrix   - 2^k x 2^k unitary for the k targets, looked up from
+               the name if not given
+    perm     - optional basis permutation for the k targets, the new
+               amplitude of |i〉 is the old amplitude of |perm[i]〉
+               (the matrix is then only built if asked for)
+    diag     - optional phases of a diagonal gate (length 2^k), |i〉
+               is multiplied by diag[i]
+    """
+    def __init__(self, name, targets, controls=(), matrix=None, perm=None, diag=None):
+        self.name = name
+        self.targets = tuple(targets)
+        self.controls = tuple(controls)
+        self.perm = perm
+        self.diag = diag
+        if matrix is None and perm is None and diag is None and name not in GATES:
+            raise ValueError(f"unknown gate '{name}'")
+        self._matrix = array(matrix) if matrix is not None else None
+        self._diagonal = False      # not checked yet
+
+    def __repr__(self):
+        return f"gate({self.name}, {list(self.targets)}, {list(self.controls)})"
+
+    def moved(self, qmap):
+        """ the same gate placed on qbits qmap[q] instead of q """
+        return gate(self.name, [qmap[t] for t in self.targets],
+                    [qmap[c] for c in self.controls], self._matrix, self.perm, self.diag)
+
+    @property
+    def matrix(self):
+        """ built on first use for permutations and wide H layers """
+        if self._matrix is None and self.perm is not None:
+            self._matrix = eye(len(self.perm))[self.perm]
+        elif self._matrix is None and self.diag is not None:
+            self._matrix = diagflat(self.diag)
+        elif self._matrix is None:
+            # a single bit gate repeated over several targets
+            matrix = GATES[self.name]
+            for _ in range(self.bits - int(log(len(matrix), 2))):
+                matrix = kron(matrix, GATES[self.name])
+            self._matrix = matrix
+        return self._matrix
+
+    @property
+    def diagonal(self):
+        """
+        Phases of the gate if it is diagonal (else None), from diag,
+        the named diagonal gates or a diagonal matrix. Found once.
+        """
+        if self._diagonal is False:
+            self._diagonal = None
+            if self.diag is not None:
+                self._diagonal = asarray(self.diag)
+            elif self.perm is None and (self._matrix is not None or self.name in DIAGONAL):
+                d = diagonal(self.matrix)
+                if count_nonzero(self.matrix) == count_nonzero(d):
+                    self._diagonal = d.copy()
+        return self._diagonal
+
+    @property
+    def bits(self):
+        return len(self.targets)
+
+    @property
+    def nbytes(self):
+        """ memory held by the gate's matrix and permutation """
+        size = self._matrix.nbytes if self._matrix is not None else 0
+        size += self.diag.nbytes if self.diag is not None else 0
+        return size + (self.perm.nbytes if self.perm is not None else 0)
+
+    @property
+    def qbits(self):
+        """ every qbit the gate touches, controls first """
+        return self.controls + self.targets
+
+    @staticmethod
+    def UnitaryF(targets, f, controls=()):
+        """
+        targets - qbits Uf acts on, the last one receives f(x)
+        f - classical boolean function on the other bits
+
+        Uf|x〉|y〉 = |x〉|y XOR f(x)〉 is stored as the basis permutation
+        which flips the last bit wherever f(x) is true.
+        """
+        n = len(targets)
+        flip = truth_table(f, n-1).astype(int64)
+        index = arange(2**n)
+        return gate("Uf", targets, controls, perm=index ^ flip[index >> 1])
+
+    @staticmethod
+    def PhaseF(targets, f, controls=()):
+        """
+        targets - qbits x the phase oracle acts on
+        f - classical boolean function on all of them
+
+        Pf|x〉 = (-1)^f(x) |x〉 needs no extra output bit and is stored
+        as its diagonal of signs.
+        """
+        return gate("Pf", targets, controls, diag=1 - 2*truth_table(f, len(targets)).astype(int64))
+
+
+def truth_table(f, n, chunk=2**20):
+    """
+    Evaluates the classical f on every n bit input, in order.
+
+    If f has a table(X) method it is handed a NumPy array X of
+    inputs (one row of n 0/1 bits per input, top bit first) and must
+    return the values of f for every row at once. Otherwise f is
+    called once per input bitstring, as in operator.UnitaryF.
+
+    Returns a boolean array of length 2^n.
+    """
+    if not hasattr(f, "table"):
+        return array([bool(f(format(i, f"0{n}b") if n else "")) for i in range(2**n)])
+
+    # inputs are handed over in chunks to bound the memory used
+    shifts = arange(n-1, -1, -1)
+    table = zeros(2**n, dtype=bool)
+    for start in range(0, 2**n, chunk):
+        index = arange(start, min(start + chunk, 2**n))
+        X = ((index[:, None] >> shifts) & 1).astype(uint8)
+        table[index] = asarray(f.table(X), dtype=bool)
+    return table
+
+
+def controlled(matrix, c):
+    """
+    Matrix of a gate controlled by c bits placed above its targets.
+    Identity everywhere except the block where all controls are 1.
+    """
+    k = matrix.shape[0]
+    mat = eye(2**c * k, dtype=matrix.dtype)
+    mat[-k:, -k:] = matrix
+    return mat
+
+
+def workspace(size, dtype):
+    """
+    Work buffer of size amplitudes. One buffer per dtype is allocated
+    (and only regrown for a bigger state), so with it applying gates
+    allocates nothing and never needs more than twice the state.
+    """
+    work = SCRATCH.get(dtype)
+    if work is None or len(work) < size:
+        work = SCRATCH[dtype] = empty(size, dtype=dtype)
+    return work[:size]
+
+
+def transform(tensor, axes, work, step):
+    """
+    Transforms the state tensor in place over the given k axes.
+
+    The amplitudes are gathered into the work buffer as a 2^k x rest
+    matrix (gate axes first), step(cols, out) then writes the new
+    values of a few columns at a time into a small per thread buffer
+    which is copied back, and the result is scattered into the tensor.
+    """
+    k = len(axes)
+    moved = moveaxis(tensor, list(axes), list(range(k)))
+    front = work.reshape(moved.shape)
+    front[...] = moved
+    flat = front.reshape(2**k, -1)
+
+    width = max(1, COLUMNS >> k)
+    small = getattr(LOCAL, "small", None)
+    if small is None or small.dtype != work.dtype or len(small) < 2**k * width:
+        small = LOCAL.small = empty(2**k * width, dtype=work.dtype)
+    for j in range(0, flat.shape[1], width):
+        cols = flat[:, j:j+width]
+        out = small[:cols.size].reshape(cols.shape)
+        step(cols, out)
+        cols[...] = out
+    moved[...] = front
+
+
+def contract(tensor, mat, axes, work):
+    """
+    Contracts the 2^k x 2^k matrix mat over the given k axes of the
+    state tensor (in place, see transform).
+    """
+    transform(tensor, axes, work, lambda cols, out: matmul(mat, cols, out=out))
+
+
+def permute(tensor, perm, axes, work):
+    """
+    Gathers the amplitudes of the state tensor over the given k axes
+    with a basis permutation of length 2^k (no matrix needed).
+    """
+    k = len(axes)
+    if tensor.flags.c_contiguous and list(axes) == list(range(k)):
+        # gate on the leading axes: one gather from a copy in the work buffer
+        rows = tensor.reshape(2**k, -1)
+        work = work.reshape(rows.shape)
+        work[...] = rows
+        take(work, perm, axis=0, out=rows, mode="clip")
+        return
+    transform(tensor, axes, work, lambda cols, out: take(cols, perm, axis=0, out=out, mode="clip"))
+
+
+def phase(tensor, diag, axes):
+    """
+    Multiplies the state tensor in place by the phases diag of a
+    diagonal gate on the given k axes (no matrix, one pass).
+    """
+    k = len(axes)
+    order = sorted(range(k), key=lambda j: axes[j])
+    d = diag.reshape((2,)*k).transpose(order)
+    shape = [1] * tensor.ndim
+    for a in axes:
+        shape[a] = 2
+    tensor *= d.reshape(shape)
+    return tensor
+
+
+def reorder(psi, where):
+    """
+    Moves the amplitudes of psi (in place, through the work buffer) so
+    that qbit q, which sits on axis where[q], is back on axis q.
+    """
+    n = len(where)
+    psi = ascontiguousarray(psi)
+    tensor = psi.reshape((2,)*n + psi.shape[1:])
+    work = workspace(psi.size, psi.dtype).reshape(tensor.shape)
+    work[...] = tensor.transpose(list(where) + list(range(n, tensor.ndim)))
+    tensor[...] = work
+    return psi
+
+
+def hadamard(tensor, axes):
+    """
+    Walsh-Hadamard transform of the state tensor over the given axes,
+    done in place with one butterfly per axis (no matrix at all).
+    """
+    for a in axes:
+        zero = tensor[(slice(None),)*a + (slice(0, 1),)]   # slices so even a
+        one = tensor[(slice(None),)*a + (slice(1, 2),)]     # 1-d tensor gives views
+        zero += one             # a + b
+        one *= -2
+        one += zero             # (a + b) - 2b = a - b
+    tensor *= 2**(-len(axes)/2)
+    return tensor
+
+
+def pool():
+    """ the thread pool (remade if THREADS was changed) """
+    global POOL
+    if POOL is None or POOL._max_workers != THREADS:
+        if POOL is not None:
+            POOL.shutdown()
+        POOL = ThreadPoolExecutor(THREADS)
+    return POOL
+
+
+def chunks(tensor, axes, n):
+    """
+    Splits the state tensor into up to THREADS independent views by
+    fixing some of its first n (qbit) axes which are not in axes, so
+    that each view keeps at least CHUNK amplitudes.
+
+    Returns the views and the gate axes within each view.
+    """
+    free = [a for a in range(n) if a not in axes]
+    m = 0
+    while 2**m < THREADS and m < len(free) and tensor.size >> (m+1) >= CHUNK:
+        m += 1
+    split = free[:m]
+    views = list()
+    for i in range(2**m):
+        index = [slice(None)] * tensor.ndim
+        for j in range(m):
+            index[split[j]] = i >> (m-j-1) & 1
+        views.append(tensor[tuple(index)])
+    return views, [a - sum(s < a for s in split) for a in axes]
+
+
+def apply(psi, g):
+    """
+    Applies gate g to the statevector psi and returns the new state.
+
+    psi has length 2^n along its first axis, any further axes (such
+    as a batch of states) are carried along untouched.
+
+    Controlled gates only touch the slice of the state tensor where
+    every control qbit is 1. H gates go through the in place
+    Walsh-Hadamard butterfly instead of a matrix and diagonal gates
+    just multiply in their phases. The work is shared out over the
+    threads in chunks (see chunks).
+    """
+    n = int(log(psi.shape[0], 2))
+    if psi.dtype.kind == "c":
+        dtype = psi.dtype           # complex states keep their precision
+    elif g.name == "H":
+        dtype = result_type(psi, float)
+    elif g.perm is not None:
+        dtype = psi.dtype
+    elif g.diagonal is not None:
+        dtype = result_type(psi, g.diagonal)
+    else:
+        dtype = result_type(psi, g.matrix)
+    psi = ascontiguousarray(psi, dtype=dtype)
+    tensor = psi.reshape((2,)*n + psi.shape[1:])
+
+    # pick out the block where all the controls are 1 (a view), the
+    # control axes are gone from the block so shift the targets
+    axes = g.targets
+    if g.controls:
+        index = [slice(None)] * tensor.ndim
+        for c in g.controls:
+            index[c] = 1
+        tensor = tensor[tuple(index)]
+        axes = [t - sum(c < t for c in g.controls) for t in g.targets]
+
+    views, axes = chunks(tensor, axes, n - len(g.controls))
+    diag = g.diagonal if g.name != "H" and g.perm is None else None
+    if diag is not None:
+        diag = diag.astype(dtype, copy=False)
+    elif g.name != "H":
+        work = workspace(tensor.size, dtype).reshape(len(views), -1)
+        mat = g.matrix.astype(dtype, copy=False) if g.perm is None else None
+
+    def kernel(i):
+        if g.name == "H":
+            hadamard(views[i], axes)
+        elif diag is not None:
+            phase(views[i], diag, axes)
+        elif g.perm is not None:
+            permute(views[i], g.perm, axes, work[i])
+        else:
+            contract(views[i], mat, axes, work[i])
+
+    if len(views) == 1:
+        kernel(0)
+    else:
+        list(pool().map(kernel, range(len(views))))
+    return psi
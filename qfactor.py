@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""
+Factored statevector: the register is kept as a product of independent
+clusters of qbits, each with its own (small) statevector.
+
+Every qbit of the input starts as a cluster of its own. A gate on the
+qbits of a single cluster is applied to that cluster's statevector
+only, and a gate spanning several clusters first merges them into one
+(the tensor product of their statevectors). Memory and time then
+depend on the largest cluster the circuit entangles, not on the total
+number of qbits, so wide circuits of loosely coupled groups of qbits
+stay cheap until their groups actually interact.
+
+SWAP gates only swap the labels of the qbits in their clusters.
+
+Measurements combine the results of the clusters: probabilities are
+products over the clusters, samples are drawn in each cluster on its
+own and the most likely states are built up a cluster at a time.
+Basis indices of registers wider than 62 qbits are Python ints.
+"""
+
+import re
+from numpy import array, arange, argsort, ascontiguousarray, lexsort, int64, float64, ones, unique, zeros
+from numpy.linalg import norm
+from numpy.random import default_rng
+
+from qengine import gate, apply
+from qstate import qstate
+
+
+def index_type(n):
+    """ dtype of the basis indices of n qbits (Python ints past 62) """
+    return int64 if n <= 62 else object
+
+
+def ranked(index, prob):
+    """ positions of the states by falling probability, then index """
+    if index.dtype == object:
+        return array(sorted(range(len(index)), key=lambda i: (-prob[i], index[i])), dtype=int64)
+    return lexsort((index, -prob))
+
+
+def partition(circuit, n):
+    """
+    Sizes of the clusters the n qbits end up in after the circuit
+    (layers of gates), largest first. SWAPs move the qbits between
+    clusters without merging them and a layer of H gates acts on each
+    qbit on its own.
+    """
+    wire = list(range(n))           # qbit -> wire of the input it holds
+    root = list(range(n))           # union-find over the wires
+
+    def find(w):
+        while root[w] != w:
+            root[w] = root[root[w]]
+            w = root[w]
+        return w
+
+    for layer in circuit:
+        for g in layer:
+            if g.name == "SWAP" and not g.controls:
+                a, b = g.targets
+                wire[a], wire[b] = wire[b], wire[a]
+                continue
+            if g.name == "H" and not g.controls:
+                continue
+            w = [find(wire[q]) for q in g.qbits]
+            for v in w[1:]:
+                root[v] = w[0]
+    sizes = dict()
+    for w in range(n):
+        sizes[find(w)] = sizes.get(find(w), 0) + 1
+    return sorted(sizes.values(), reverse=True)
+
+
+class cluster:
+    """
+    Statevector psi of the qbits listed (psi's axes in that order).
+    """
+    def __init__(self, qbits, psi):
+        self.qbits = list(qbits)
+        self.psi = psi
+
+    @property
+    def prob(self):
+        return (abs(self.psi)**2).astype(float64, copy=False)
+
+    def spread(self, index, n):
+        """ basis indices of the cluster as basis indices of all n qbits """
+        m = len(self.qbits)
+        full = zeros(len(index), dtype=index_type(n))
+        for i in range(m):
+            full |= (index >> (m-i-1) & 1).astype(full.dtype) << (n - self.qbits[i] - 1)
+        return full
+
+
+class fstate:
+    """
+    Register of n qbits kept as a product of clusters of qbits.
+
+    state - input string as in qstate (product state)
+    dtype - complex precision of the amplitudes
+    """
+    def __init__(self, state="0", dtype=complex):
+        self.clusters = list()
+        for m in re.findall(r"(\[[\d\., ]+\]|[01])", state):
+            if m in ("0", "1"):
+                v = array([m == "0", m == "1"], dtype=dtype)
+            else:
+                v = array([float(a) for a in m[1:-1].split(',')], dtype=dtype)
+            self.clusters.append(cluster([len(self.clusters)], v / norm(v)))
+        self.n = len(self.clusters)
+        self.owner = self.clusters[:]       # cluster of each qbit
+
+    def __len__(self):
+        return 2**self.n
+
+    def __str__(self):
+        if self.n <= 16:
+            return str(qstate(self.state, norm=False))
+        return f"{self.n} qbits in {len(self.clusters)} clusters (largest {self.largest} qbits)"
+
+    @property
+    def bits(self):
+        return self.n
+
+    @property
+    def largest(self):
+        """ qbits of the largest cluster """
+        return max(len(c.qbits) for c in self.clusters)
+
+    pure_states = staticmethod(qstate.pure_states)
+
+    def merge(self, parts):
+        """ merges the clusters into the first one (tensor product) """
+        first = parts[0]
+        for c in parts[1:]:
+            first.psi = (first.psi[:, None] * c.psi[None, :]).reshape(-1)
+            first.qbits += c.qbits
+            for q in c.qbits:
+                self.owner[q] = first
+            self.clusters.remove(c)
+        return first
+
+    def apply(self, g):
+        """
+        Applies a qengine gate, merging the clusters it spans first. An
+        uncontrolled SWAP just swaps the labels of its two qbits and an
+        H layer is applied a qbit at a time.
+        """
+        if g.name == "I":
+            return
+        if g.name == "H" and not g.controls and g.bits > 1:
+            for t in g.targets:
+                self.apply(gate("H", [t]))
+            return
+        if g.name == "SWAP" and not g.controls:
+            a, b = g.targets
+            A, B = self.owner[a], self.owner[b]
+            i, j = A.qbits.index(a), B.qbits.index(b)
+            A.qbits[i], B.qbits[j] = b, a
+            self.owner[a], self.owner[b] = B, A
+            return
+        parts = list()
+        for q in g.qbits:
+            if self.owner[q] not in parts:
+                parts.append(self.owner[q])
+        c = self.merge(parts) if len(parts) > 1 else parts[0]
+        axis = {c.qbits[i]: i for i in range(len(c.qbits))}
+        c.psi = apply(c.psi, g.moved(axis))
+
+    @property
+    def state(self):
+        """ statevector of all the qbits (only sensible for few qbits) """
+        psi = ones(1, dtype=self.clusters[0].psi.dtype)
+        qbits = list()
+        for c in self.clusters:
+            psi = (psi[:, None] * c.psi[None, :]).reshape(-1)
+            qbits += c.qbits
+        order = sorted(range(self.n), key=lambda i: qbits[i])
+        return ascontiguousarray(psi.reshape((2,)*self.n).transpose(order)).reshape(-1)
+
+    @property
+    def prob(self):
+        """ probabilities of pure states (all of them in memory) """
+        return self.marginal(self.n)
+
+    def marginal(self, top):
+        """
+        Probabilities of the pure states of the top 'top' bits: the
+        product of the marginals of each cluster over its top qbits.
+        """
+        p = ones((2,)*top, dtype=float64)
+        for c in self.clusters:
+            keep = [i for i in range(len(c.qbits)) if c.qbits[i] < top]
+            if not keep:
+                continue
+            rest = tuple(i for i in range(len(c.qbits)) if c.qbits[i] >= top)
+            mc = c.prob.reshape((2,)*len(c.qbits)).sum(axis=rest)
+            order = sorted(range(len(keep)), key=lambda j: c.qbits[keep[j]])
+            shape = [1] * top
+            for i in keep:
+                shape[c.qbits[i]] = 2
+            p = p * mc.transpose(order).reshape(shape)
+        return p.reshape(-1)
+
+    def joint_prob(self, pattern):
+        """ probability of a measurement matching the pattern (see qstate) """
+        p = 1.0
+        for c in self.clusters:
+            m = len(c.qbits)
+            mask = value = 0
+            for i in range(m):
+                q = c.qbits[i]
+                if q < len(pattern) and pattern[q] != 'x':
+                    mask |= 1 << (m-i-1)
+                    value |= int(pattern[q]) << (m-i-1)
+            if mask:
+                p *= c.prob[arange(2**m) & mask == value].sum(dtype=float64)
+        return p
+
+    def sample(self, shots, rng=None):
+        """
+        Draws 'shots' measurements without collapsing the state, each
+        cluster's bits of every shot drawn from that cluster alone.
+        """
+        rng = default_rng(rng)
+        index = zeros(shots, dtype=index_type(self.n))
+        for c in self.clusters:
+            p = c.prob
+            drawn = rng.choice(len(p), shots, p=p / p.sum())
+            index |= c.spread(drawn, self.n)
+        index, counts = unique(index, return_counts=True)
+        return dict(zip(index.tolist(), counts.tolist()))
+
+    def top(self, k):
+        """
+        The k most likely pure states, combining the best k states of
+        each cluster (ties go to the lower index).
+        """
+        index, prob = zeros(1, dtype=index_type(self.n)), ones(1)
+        for c in self.clusters:
+            p = c.prob
+            spread = c.spread(arange(len(p)), self.n)
+            best = ranked(spread, p)[:k]
+            index = (index[:, None] | spread[best][None, :]).reshape(-1)
+            prob = (prob[:, None] * p[best][None, :]).reshape(-1)
+            keep = ranked(index, prob)[:k]
+            index, prob = index[keep], prob[keep]
+        return index, prob
+
+    def above(self, threshold):
+        """
+        The pure states with probability > threshold. A state can't be
+        more likely than its part in any cluster, so each cluster only
+        adds its states above the threshold.
+        """
+        index, prob = zeros(1, dtype=index_type(self.n)), ones(1)
+        for c in self.clusters:
+            p = c.prob
+            j = (p > threshold).nonzero()[0]
+            index = (index[:, None] | c.spread(j, self.n)[None, :]).reshape(-1)
+            prob = (prob[:, None] * p[j][None, :]).reshape(-1)
+            keep = prob > threshold
+            index, prob = index[keep], prob[keep]
+        order = argsort(index, kind="stable")
+        return index[order], prob[order]
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Matrix product state (MPS) simulation of quantum circuits.
+
+The state of n qbits is stored as a chain of n tensors A[i] of shape
+(chi_left, 2, chi_right) rather than 2^n amplitudes. Circuits which
+only build up a little entanglement keep the bond dimensions chi
+small, so wide circuits can be simulated cheaply.
+
+Bond dimensions are capped at 'chi' and singular values carrying less
+than 'cutoff' of the weight are dropped, the discarded weight is added
+up in the truncation error. Measurements are computed directly from
+the tensors without expanding to 2^n amplitudes.
+"""
+
+import re
+from heapq import heappush, heappop
+from numpy import array, ones, zeros, arange, sqrt, einsum, tensordot, transpose, conj, real, cumsum, unique
+from numpy.linalg import qr, svd, norm
+from numpy.random import default_rng
+
+from qstate import qstate
+from qengine import controlled
+from qstabilizer import to_index
+
+LIMIT = 2**20       # most prefixes searched by top and above
+
+
+class mps:
+    """
+    Matrix product state of n qbits, q0 being the first tensor.
+
+    state  - input string as in qstate (product state)
+    chi    - largest bond dimension kept (None for no cap)
+    cutoff - relative weight below which singular values are dropped
+    """
+    def __init__(self, state="0", chi=None, cutoff=1e-12):
+        self.chi = chi
+        self.cutoff = cutoff
+        self.error = 0.0            # accumulated truncated weight
+        self.tensors = list()
+        for m in re.findall(r"(\[[\d\., ]+\]|[01])", state):
+            if m == "0":
+                v = array([1, 0])
+            elif m == "1":
+                v = array([0, 1])
+            else:
+                v = array([float(a) for a in m[1:-1].split(',')])
+            self.tensors.append((v / norm(v)).astype(complex).reshape(1, 2, 1))
+        self.center = 0             # orthogonality center of the chain
+
+    def __str__(self):
+        if self.bits <= 16:
+            return str(qstate(self.state, norm=False))
+        return f"MPS of {self.bits} qbits (bond dimension {self.bond})"
+
+    def __len__(self):
+        return 2**self.bits
+
+    @property
+    def bits(self):
+        return len(self.tensors)
+
+    @property
+    def bond(self):
+        """ largest bond dimension in the chain """
+        return max(A.shape[2] for A in self.tensors)
+
+    def _move_center(self, site):
+        """ shifts the orthogonality center to 'site' with QR sweeps """
+        while self.center < site:
+            i = self.center
+            A = self.tensors[i]
+            q, r = qr(A.reshape(-1, A.shape[2]))
+            self.tensors[i] = q.reshape(A.shape[0], 2, -1)
+            self.tensors[i+1] = tensordot(r, self.tensors[i+1], axes=1)
+            self.center += 1
+        while self.center > site:
+            i = self.center
+            A = self.tensors[i]
+            q, r = qr(A.reshape(A.shape[0], -1).T)
+            self.tensors[i] = q.T.reshape(-1, 2, A.shape[2])
+            self.tensors[i-1] = tensordot(self.tensors[i-1], r.T, axes=1)
+            self.center -= 1
+
+    def _split(self, theta, site, k):
+        """
+        Splits the block tensor theta (chi_l, 2, ..., 2, chi_r) back
+        into k sites starting at 'site', truncating each bond.
+        """
+        for i in range(site, site+k-1):
+            chi_l = theta.shape[0]
+            u, s, v = svd(theta.reshape(chi_l*2, -1), full_matrices=False)
+
+            # drop the singular values below the cutoff or over the cap
+            weight = s**2 / (s**2).sum()
+            keep = max(1, int((cumsum(weight[::-1])[::-1] > self.cutoff).sum()))
+            if self.chi:
+                keep = min(keep, self.chi)
+            self.error += weight[keep:].sum()
+            s = s[:keep] / norm(s[:keep])
+
+            self.tensors[i] = u[:, :keep].reshape(chi_l, 2, keep)
+            theta = (s[:, None] * v[:keep]).reshape((keep,) + theta.shape[2:])
+        self.tensors[site+k-1] = theta
+        self.center = site+k-1
+
+    def _apply_block(self, mat, site, k):
+        """ applies the 2^k x 2^k matrix to the k sites from 'site' on """
+        self._move_center(site)
+        theta = self.tensors[site]
+        for i in range(site+1, site+k):
+            theta = tensordot(theta, self.tensors[i], axes=1)
+        op = mat.reshape((2,)*(2*k))
+        theta = tensordot(op, theta, axes=(list(range(k, 2*k)), list(range(1, k+1))))
+        theta = transpose(theta, [k] + list(range(k)) + [k+1])
+        if k == 1:
+            self.tensors[site] = theta
+        else:
+            self._split(theta, site, k)
+
+    def _swap(self, i):
+        """ swaps the neighbouring sites i and i+1 """
+        self._apply_block(array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]]), i, 2)
+
+    def apply(self, g):
+        """
+        Applies a qengine gate. Gates on distant qbits are applied by
+        swapping their sites next to each other and back again.
+        """
+        if g.name == "I":
+            return
+        if g.name == "H" and not g.controls and g.bits > 1:
+            H = array([[1, 1], [1, -1]]) / sqrt(2)
+            for t in g.targets:
+                self._apply_block(H, t, 1)
+            return
+        qbits = list(g.qbits)
+        mat = controlled(g.matrix, len(g.controls)) if g.controls else g.matrix
+
+        # reorder the gate to act on its qbits in chain order
+        k = len(qbits)
+        order = sorted(range(k), key=lambda j: qbits[j])
+        op = mat.reshape((2,)*(2*k)).transpose(order + [k+j for j in order])
+        sites = [qbits[j] for j in order]
+
+        # bring the sites together, apply, and move them back
+        swaps = list()
+        for j in range(1, k):
+            for i in range(sites[j]-1, sites[0]+j-1, -1):
+                self._swap(i)
+                swaps.append(i)
+        self._apply_block(op.reshape(2**k, 2**k), sites[0], k)
+        for i in reversed(swaps):
+            self._swap(i)
+
+    @property
+    def state(self):
+        """ statevector of the MPS (only sensible for few qbits) """
+        psi = ones((1, 1))
+        for A in self.tensors:
+            psi = tensordot(psi, A, axes=1).reshape(-1, A.shape[2])
+        return psi[:, 0]
+
+    def _environments(self):
+        """
+        Right environments R[i] = Σ_s A[i:] A[i:]^† over all outcomes of
+        sites i..n-1, R[n] being the trivial 1 x 1 environment.
+        """
+        R = [None] * (self.bits+1)
+        R[-1] = ones((1, 1))
+        for i in range(self.bits-1, -1, -1):
+            A = self.tensors[i]
+            R[i] = einsum("asb,bc,dsc->ad", A, R[i+1], conj(A))
+        return R
+
+    @property
+    def prob(self):
+        """ probabilities of pure states (only sensible for few qbits) """
+        return abs(self.state)**2
+
+    def joint_prob(self, pattern):
+        """
+        Probability of a measurement matching the pattern (see qstate),
+        found by sweeping transfer matrices over the chain.
+        """
+        E = ones((1, 1))
+        for i in range(self.bits):
+            A = self.tensors[i]
+            if i < len(pattern) and pattern[i] != 'x':
+                A = A[:, [int(pattern[i])], :]
+            E = einsum("ab,asc,bsd->cd", E, A, conj(A))
+        return real(E[0, 0])
+
+    def marginal(self, top):
+        """
+        Probabilities of the pure states of the top 'top' bits, the
+        other bits are summed out with the right environment.
+        """
+        R = self._environments()
+        E = ones((1, 1, 1))
+        for i in range(top):
+            A = self.tensors[i]
+            E = einsum("oab,asc,bsd->oscd", E, A, conj(A))
+            E = E.reshape((-1,) + E.shape[2:])
+        return real(einsum("oab,ab->o", E, R[top])).clip(0)
+
+    def sample(self, shots, rng=None):
+        """
+        Draws 'shots' measurements of the state without collapsing it.
+        All shots are sampled together, site by site, from their
+        conditional probabilities given the bits drawn so far.
+
+        Returns a histogram {basis index: count} of the outcomes seen.
+        """
+        rng = default_rng(rng)
+        R = self._environments()
+        L = ones((shots, 1), dtype=complex)
+        bits = zeros((shots, self.bits), dtype=bool)
+        for i in range(self.bits):
+            A = self.tensors[i]
+            v = einsum("na,asb->nsb", L, A)
+            p = real(einsum("nsb,bc,nsc->ns", v, R[i+1], conj(v)))
+            one = rng.random(shots) * p.sum(axis=1) < p[:, 1]
+            bits[:, i] = one
+            L = v[arange(shots), one.astype(int)]
+            L /= norm(L, axis=1)[:, None]
+        bits, counts = unique(bits, axis=0, return_counts=True)
+        return dict(zip(to_index(bits), counts.tolist()))
+
+    def _extend(self, R, i, L):
+        """
+        Left vectors and probabilities of the prefixes L (one row each,
+        over sites 0..i-1) extended by site i with a 0 and with a 1.
+        """
+        v = einsum("na,asb->nsb", L, self.tensors[i])
+        return v, real(einsum("nsb,bc,nsc->ns", v, R[i+1], conj(v))).clip(0)
+
+    def top(self, k):
+        """
+        The k most likely pure states, found by a best first search
+        over the chain. The probability of a prefix of bits bounds that
+        of all the states it leads to, so full states come off the heap
+        most likely first (ties, to 12 digits, to the lower index).
+        """
+        R = self._environments()
+        heap = [(-1.0, (), 1.0, ones(1, dtype=complex))]
+        index, prob = list(), list()
+        expanded = 0
+        while heap and len(index) < k:
+            _, bits, p, L = heappop(heap)
+            if len(bits) == self.bits:
+                index.append(int("".join(map(str, bits)), 2))
+                prob.append(p)
+                continue
+            expanded += 1
+            if expanded > LIMIT:
+                raise ValueError(f"more than {LIMIT} prefixes searched for the top {k} states, too many to list")
+            v, q = self._extend(R, len(bits), L[None, :])
+            for s in (0, 1):
+                heappush(heap, (-round(q[0, s], 12), bits + (s,), q[0, s], v[0, s]))
+        return array(index, dtype=object), prob
+
+    def above(self, threshold):
+        """
+        The pure states with probability > threshold, found a site at
+        a time keeping only the prefixes of bits above the threshold
+        (never more than 1/threshold of them).
+        """
+        R = self._environments()
+        L = ones((1, 1), dtype=complex)
+        index, prob = [0], ones(1)
+        for i in range(self.bits):
+            v, p = self._extend(R, i, L)
+            keep = (p > threshold).nonzero()
+            if len(keep[0]) > LIMIT:
+                raise ValueError(f"more than {LIMIT} states above {threshold}, too many to list")
+            L = v[keep]
+            index = [index[j] << 1 | int(s) for j, s in zip(*keep)]
+            prob = p[keep]
+        return array(index, dtype=object), prob.tolist()
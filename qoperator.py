@@ -5,21 +5,27 @@ Defines the basic multi-bit quantum states.
 
 The operator class is used to store all quantum gates
 used in the circuits constructed in qsim.
+
+Matrices are plain ndarrays of an explicit dtype (complex by default).
 """
 
 from math import log
-from numpy import array, ndarray, matrix, kron, matmul, eye, allclose, zeros, column_stack, zeros, flip
+from numpy import asarray, ndarray, kron, matmul, eye, allclose, flip, arange, ones
+from numpy.linalg import matrix_power
 
 from qstate import qstate
+from qengine import truth_table
 
 
 class operator:
     """
     Basic unitary linear quantum operator.
     
-    Matrix size (2^n x 2^n) for n bit input / output.
+    Matrix size (2^n x 2^n) for n bit input / output, stored as an
+    ndarray of the given dtype.
     """
-    def __init__(self, mat="I", n=1):
+    def __init__(self, mat="I", n=1, dtype=complex):
+        self.dtype = dtype
         if isinstance(mat, str):
             if mat == "NOT":
                 self.matrix = self.NOT(n).matrix
@@ -41,7 +47,8 @@ class operator:
         for i in range(self.matrix.shape[0]):
             string += "| "
             for j in range(self.matrix.shape[1]):
-                string += "{:6.3f} ".format(self.matrix[i, j])
+                a = self.matrix[i, j]
+                string += "{:6.3f} ".format(a if a.imag else a.real)
             string += "|\n"
         return string[:-1]
 
@@ -53,7 +60,7 @@ class operator:
         for i in range(self.matrix.shape[0]):
             string += "  "
             for j in range(self.matrix.shape[1]):
-                string += f"{int(self.matrix[i, j])} & "
+                string += f"{int(self.matrix[i, j].real)} & "
             string = string[:-2] + "\\\\\n"
         return string + "\\end{bmatrix}"
 
@@ -63,20 +70,27 @@ class operator:
          - another operator matrix      -> new operator matrix
          - a qstate vector or ndarray   -> new qstate vector
          - a scalar                     -> new operator matrix
+
+        Use apply to write into a preallocated buffer instead.
         """
-        if isinstance(other, (int, float)):
-            return operator(other*self.matrix)
+        if isinstance(other, (int, float, complex)):
+            return operator(other*self.matrix, dtype=self.dtype)
         elif isinstance(other, qstate):
-            newmat = matmul(array(self.matrix), other.state)
-            return qstate(newmat, norm=False)
+            return qstate(self.apply(other.state), norm=False)
         elif isinstance(other, ndarray):
-            newmat = matmul(array(self.matrix), other)
-            return qstate(newmat, norm=False)
-        newmat = matmul(self.matrix, other.matrix)
-        return operator(newmat)
+            return qstate(self.apply(other), norm=False)
+        return operator(matmul(self.matrix, other.matrix), dtype=self.dtype)
+
+    def apply(self, state, out=None):
+        """
+        Multiplies the statevector (or 2^n x B batch) by the operator.
+        The result is written to out if given (which must not be state)
+        so repeated layers can reuse a pair of buffers.
+        """
+        return matmul(self.matrix, state, out=out)
 
     def __pow__(self, n):
-        return operator(self.matrix**n)
+        return operator(matrix_power(self.matrix, n), dtype=self.dtype)
 
     def tensor(op1, op2, *args):
         """
@@ -85,11 +99,11 @@ class operator:
         newmat = kron(op1.matrix, op2.matrix)
         for op in args:
             newmat = kron(newmat, op.matrix)
-        return operator(newmat)
+        return operator(newmat, dtype=op1.dtype)
 
     def valid(self):
         shape = self.matrix.shape[0] == self.matrix.shape[1]
-        unitary = allclose(eye(self.matrix.shape[0]), self.matrix.H * self.matrix)
+        unitary = allclose(eye(self.matrix.shape[0]), self.matrix.conj().T @ self.matrix)
         return shape and unitary
 
     @property
@@ -110,12 +124,11 @@ class operator:
         Used to initialize the underlying matrix correctly.
         """
         if isinstance(newmatrix, (list, ndarray)):
-            newmatrix = matrix(newmatrix)
-        if isinstance(newmatrix, matrix):
-            if newmatrix.shape[0] == newmatrix.shape[1]:
+            newmatrix = asarray(newmatrix, dtype=self.dtype)
+            if newmatrix.ndim == 2 and newmatrix.shape[0] == newmatrix.shape[1]:
                 self._matrix = newmatrix
                 return
-        self._matrix = eye(2)       # default to I2
+        self._matrix = eye(2, dtype=self.dtype)       # default to I2
 
     @staticmethod
     def Control(gate, bits, target, control):
@@ -134,31 +147,20 @@ class operator:
 
         Returns a matrix representing the whole layer.
         """
-        # first we need a classical function representing controlled NOT
-        def cf(x, cx, state, OP):
-            """
-            x is a n bit binary input
-            returns OP(tx) if cx all true
-            """
-            if sum(int(x[i]) for i in cx) == len(cx):
-                return (OP * state).state
-            return state
-
         # construct the operator to be used conditionally
         I1 = operator("I", target)                  # first bits from [0, target)
         I2 = operator("I", bits-target-gate.bits)   # last bits (target, end]
         op = operator.tensor(I1, gate, I2)
 
-        # now construct the matrix using this function on the basis vectors
-        cols = list()
-        ps = qstate.pure_states(bits)
-        n = 2**bits
-        for i in range(n):
-            x = zeros(n)
-            x[i] = 1
-            c = cf(ps[i], control, x, op)
-            cols.append( c )
-        return operator(column_stack(cols))
+        # basis columns where every control bit is 1 get the operator,
+        # all others are left alone (identity)
+        index = arange(2**bits)
+        mask = ones(2**bits, dtype=bool)
+        for c in control:
+            mask &= (index >> (bits-c-1)) & 1 == 1
+        mat = eye(2**bits, dtype=op.matrix.dtype)
+        mat[:, mask] = op.matrix[:, mask]
+        return operator(mat, dtype=op.dtype)
 
     @staticmethod
     def UnitaryF(n, f):
@@ -171,19 +173,9 @@ class operator:
         Returns a matrix operator Uf which implements f in a 
         reversible unitary quantum operator.
         """
-        purestates = qstate.pure_states(n-1)
-        uf = zeros((2**n, 2**n))
-        for i in range(len(purestates)):
-            # state = [int(x) for x in purestates[i]]
-            if f(purestates[i]) == 0:
-                # Fill with I
-                uf[2*i][2*i] = 1
-                uf[2*i+1][2*i+1] = 1
-            else:
-                # Fill with NOT
-                uf[2*i+1][2*i] = 1
-                uf[2*i][2*i+1] = 1
-        return operator(uf)
+        flip = truth_table(f, n-1).astype(int)
+        index = arange(2**n)
+        return operator(eye(2**n)[index ^ flip[index >> 1]])
 
     @staticmethod
     def Identity(n=1):
@@ -204,12 +196,12 @@ class operator:
         """
         n bit input / output Hadamard gate
         """
-        if Qadamards[n]:
+        if n in Qadamards:
             return Qadamards[n] * 2**(-n/2)
-        if not Qadamards[1]:
+        if 1 not in Qadamards:
             Qadamards[1] = operator([[1, 1], [1, -1]])
         for i in range(2, n+1):
-            if Qadamards[i]: continue
+            if i in Qadamards: continue
             Qadamards[i] = operator.tensor(Qadamards[i-1], Qadamards[1])
         return Qadamards[n] * 2**(-n/2)
 
@@ -239,4 +231,4 @@ class operator:
         op = [[1,0,0,0],[0,0,1,0],[0,1,0,0],[0,0,0,1]]
         return operator(op)
 
-Qadamards = [None for _ in range(11)]
+Qadamards = dict()
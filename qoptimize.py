@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+"""
+Peephole optimization of constructed circuits.
+
+Runs over the layers of qengine gates made by qsim.construct_operator
+before they are simulated and
+
+  1. cancels adjacent pairs of the same self-inverse gate
+     (H.H, NOT.NOT, PAULIz.PAULIz, SWAP.SWAP, Uf.Uf, Pf.Pf)
+  2. merges runs of uncontrolled single qbit gates on the same qbit
+     into one 2x2 gate (dropping it if it comes out as identity)
+  3. drops identity gates and layers left empty
+
+Gates are adjacent when nothing else touches their qbits in between,
+so they may sit in different layers.
+
+prune() keeps only the light cone of the measured qbits: the gates
+which can change what is measured.
+
+relabel() takes the SWAP gates out from between the other gates by
+renaming the qbits of the gates after them (the SWAPs left at the end
+are free for the statevector backends, which just relabel qbits).
+
+fuse() then groups runs of gates on a few qbits into one dense gate,
+so the statevector is swept once per group rather than once per gate.
+
+fold() last of all folds runs of diagonal gates (PAULIz, phase
+oracles, diagonal fused gates, ...) into a single vector of phases,
+applied with one elementwise multiply over the state.
+"""
+
+from numpy import allclose, array_equal, eye, ones, arange, where, int64
+
+from qengine import gate, apply
+
+
+SELF_INVERSE = ("H", "NOT", "S", "PAULIz", "SWAP", "Uf", "Pf")
+
+
+def cancels(g1, g2):
+    """ checks if g2 undoes g1 (same self-inverse gate on the same bits) """
+    if g1.name != g2.name or g1.name not in SELF_INVERSE:
+        return False
+    if set(g1.controls) != set(g2.controls):
+        return False
+    if g1.name == "SWAP":
+        return set(g1.targets) == set(g2.targets)
+    if g1.targets != g2.targets:
+        return False
+    if g1.diag is not None:
+        return array_equal(g1.diag, g2.diag)
+    return g1.perm is None or array_equal(g1.perm, g2.perm)
+
+
+def single(g):
+    """ checks if g is an uncontrolled gate on one qbit """
+    return g.bits == 1 and not g.controls
+
+
+def optimize(circuit, merge=True):
+    """
+    Optimizes the circuit (list of layers of gates) and returns the
+    new circuit and a report {"layers": (before, after),
+    "gates": (before, after), "cancelled": #, "merged": #,
+    "identities": #}.
+
+    merge=False keeps the gates as they are (only cancelling and
+    dropping), e.g. to leave a Clifford circuit for the stabilizer.
+    """
+    report = {"cancelled": 0, "merged": 0, "identities": 0}
+
+    # flatten into one gate per H target so each can cancel on its own
+    gates = list()
+    for l in range(len(circuit)):
+        for g in circuit[l]:
+            if g.name == "H" and not g.controls:
+                gates += [(l, gate("H", [t])) for t in g.targets]
+            else:
+                gates.append((l, g))
+    report["gates"] = [len(gates)]
+
+    # stacks of the gates (positions in out) last touching each qbit
+    out = list()
+    last = dict()
+    for l, g in gates:
+        if g.name == "I":
+            report["identities"] += 1
+            continue
+        qbits = set(g.qbits)
+        prev = {last[q][-1] if last.get(q) else None for q in qbits}
+        p = prev.pop() if len(prev) == 1 else None
+        if p is not None and set(out[p][1].qbits) != qbits:
+            p = None
+
+        if p is not None and cancels(out[p][1], g):
+            report["cancelled"] += 2
+            out[p] = None
+            for q in qbits:
+                last[q].pop()
+        elif p is not None and merge and single(g) and single(out[p][1]):
+            report["merged"] += 1
+            mat = g.matrix @ out[p][1].matrix
+            if allclose(mat, eye(2)):
+                report["identities"] += 1
+                out[p] = None
+                last[g.targets[0]].pop()
+            else:
+                out[p] = (out[p][0], gate("U", g.targets, matrix=mat))
+        else:
+            for q in qbits:
+                last.setdefault(q, list()).append(len(out))
+            out.append((l, g))
+
+    # regroup the gates into their layers, joining up H gates again
+    layers = dict()
+    for item in out:
+        if item is None:
+            continue
+        l, g = item
+        layer = layers.setdefault(l, list())
+        if g.name == "H" and not g.controls:
+            for i in range(len(layer)-1, -1, -1):
+                if layer[i].name == "H" and not layer[i].controls:
+                    layer[i] = gate("H", layer[i].targets + g.targets)
+                    break
+                if set(layer[i].qbits) & set(g.targets):
+                    layer.append(g)
+                    break
+            else:
+                layer.append(g)
+        else:
+            layer.append(g)
+    optimized = [layers[l] for l in sorted(layers)]
+
+    report["gates"].append(sum(1 for item in out if item is not None))
+    report["layers"] = (len(circuit), len(optimized))
+    report["gates"] = tuple(report["gates"])
+    return optimized, report
+
+
+def prune(circuit, measured):
+    """
+    Light cone of the measured qbits. Walks the circuit backwards and
+    keeps the gates touching a qbit which can still reach a measured
+    one, their qbits then join the cone. H gates lose their targets
+    outside the cone (each target is a gate of its own sharing the
+    controls).
+
+    Returns the kept circuit, the qbits of the cone (sorted) and the
+    number of gates before and after (counting H per target).
+    """
+    cone = set(measured)
+    kept = list()
+    before = after = 0
+    for layer in reversed(circuit):
+        new = list()
+        for g in reversed(layer):
+            before += g.bits if g.name == "H" else 1
+            if g.name == "H":
+                # one H per target, all of them if a control is in the cone
+                targets = [t for t in g.targets if t in cone or cone & set(g.controls)]
+                if not targets:
+                    continue
+                g = gate("H", targets, g.controls) if len(targets) < g.bits else g
+            elif g.name == "I" or not cone & set(g.qbits):
+                continue
+            after += g.bits if g.name == "H" else 1
+            cone.update(g.qbits)
+            new.append(g)
+        if new:
+            kept.append(new[::-1])
+    return kept[::-1], sorted(cone), (before, after)
+
+
+def relabel(circuit):
+    """
+    Moves the uncontrolled SWAP gates of the circuit to its end: each
+    SWAP exchanges the labels of its qbits for the gates after it
+    instead. The SWAPs at the end then put the qbits back in order.
+
+    Returns the new circuit.
+    """
+    where = dict()          # qbit of the circuit -> qbit of the new circuit
+    moved = list()
+    for layer in circuit:
+        # the gates of a layer are on distinct qbits, so the SWAPs can go last
+        kept = [g for g in layer if g.name != "SWAP" or g.controls]
+        if where:
+            kept = [g.moved({q: where.get(q, q) for q in g.qbits}) for g in kept]
+        if kept:
+            moved.append(kept)
+        for g in layer:
+            if g.name == "SWAP" and not g.controls:
+                a, b = g.targets
+                where[a], where[b] = where.get(b, b), where.get(a, a)
+
+    # sort the labels back, a SWAP at a time
+    for q in sorted(where):
+        p = where[q]
+        if p != q:
+            r = next(r for r in where if where[r] == q)
+            moved.append([gate("SWAP", [q, p])])
+            where[q], where[r] = q, p
+    return moved
+
+
+def fuse(circuit, k=4):
+    """
+    Fuses consecutive gates of the circuit which together touch at
+    most k qbits into one gate with a 2^k x 2^k (or smaller) matrix.
+
+    Gates on more than k qbits are kept as they are, as are groups of
+    a single gate (so H layers and Uf permutations keep their fast
+    paths) and uncontrolled SWAPs, which the backends apply by
+    relabelling qbits. Returns the new circuit with one layer per group.
+    """
+    fused = list()
+    group, qbits = list(), list()
+
+    def flush():
+        if len(group) == 1:
+            fused.append(group[:])
+        elif group:
+            # apply the group to every basis state of its qbits at once
+            axis = {qbits[i]: i for i in range(len(qbits))}
+            mat = eye(2**len(qbits), dtype=complex)
+            for g in group:
+                mat = apply(mat, g.moved(axis))
+            fused.append([gate("FUSED", qbits, matrix=mat)])
+        group.clear()
+        qbits.clear()
+
+    for layer in circuit:
+        for g in layer:
+            if g.name == "SWAP" and not g.controls:
+                flush()
+                fused.append([g])
+                continue
+            new = [q for q in g.qbits if q not in qbits]
+            if len(qbits) + len(new) > k:
+                flush()
+                new = list(g.qbits)
+            if len(new) > k:
+                fused.append([g])
+                continue
+            group.append(g)
+            qbits.extend(new)
+    flush()
+    return fused
+
+
+def expand(g, qbits):
+    """
+    Phases of the diagonal gate g over the basis of qbits (a sorted
+    superset of its qbits), 1 wherever one of its controls is 0.
+    """
+    m = len(qbits)
+    index = arange(2**m, dtype=int64)
+    bit = {qbits[p]: (index >> (m-p-1)) & 1 for p in range(m)}
+    local = 0
+    for t in g.targets:
+        local = (local << 1) | bit[t]
+    on = ones(2**m, dtype=bool)
+    for c in g.controls:
+        on &= bit[c] == 1
+    return where(on, g.diagonal[local], 1)
+
+
+def fold(circuit, limit=20):
+    """
+    Folds each run of consecutive diagonal gates of the circuit into
+    one "DIAG" gate over all of their qbits, as long as they span at
+    most 'limit' qbits (or a single gate is wider).
+
+    Returns the new circuit and the number of gates folded away.
+    """
+    folded = list()
+    run, qbits = list(), set()
+    removed = 0
+
+    def flush():
+        nonlocal removed
+        if len(run) == 1:
+            folded.append(run[:])
+        elif run:
+            order = sorted(qbits)
+            diag = ones(2**len(order), dtype=complex)
+            for g in run:
+                diag *= expand(g, order)
+            folded.append([gate("DIAG", order, diag=diag)])
+            removed += len(run) - 1
+        run.clear()
+        qbits.clear()
+
+    for layer in circuit:
+        for g in layer:
+            if g.name == "H" or g.perm is not None or g.diagonal is None:
+                flush()
+                folded.append([g])
+                continue
+            if run and len(qbits | set(g.qbits)) > limit:
+                flush()
+            run.append(g)
+            qbits.update(g.qbits)
+    flush()
+    return folded, removed
@@ -51,25 +51,46 @@ def parse_layer(match, debug=False):
     return layer
 
 
+def parse_inputs(spec, n):
+    """
+    Reads the list of input states given with the inputs keyword.
+
+      inputs = 000 011 [1,1]01   -->  the states listed
+      inputs = range 2 6         -->  basis states 2, 3, 4 and 5
+      inputs = all               -->  all 2^n basis states
+    """
+    match = re.findall(r"^range +(\d+) +(\d+)", spec)
+    if len(match):
+        start, stop = (int(a) for a in match[0])
+        return [format(i, f"0{n}b") for i in range(start, stop)]
+    if spec == "all":
+        return [format(i, f"0{n}b") for i in range(2**n)]
+    return re.findall(r"(?:\[[\d\., ]+\]|[01])+", spec)
+
+
 def parse(qc_file, debug=False):
     """
     Parses a .qc quantum circuit file.
 
     Obtains the following information:
       qbits - the number of qbits in the circuit (and maybe the names?)
-      state - the initial state of the qbits of the circuit
+      state - the initial state of the qbits of the circuit (or a list
+              of them to simulate as a batch, see parse_inputs)
       layers - the quantum gates forming each layer and what qbits they operate on
       function - the classical function and arguments to apply in Uf
       measurements - requests of measurement on the final state of the system
+      options - other settings of the circuit, such as the precision
     
     Returns the qbits and layers of the circuit.
     """
     # program parameters
     num_qbits = 0
     state = None
+    batch = None
     function = None
     layers = list()
     measurements = list()
+    options = dict()
 
     # read in the file for parsing
     with open(qc_file, 'r') as f:
@@ -91,6 +112,13 @@ def parse(qc_file, debug=False):
             if debug: print(f"  {num_qbits} qbits\n")
             continue
 
+        # check for a batch of input states to run the circuit over
+        match = re.findall(r"^inputs *=? *(.*)", line)
+        if len(match):
+            batch = match[0].strip()
+            if debug: print(f"  input states {batch}\n")
+            continue
+
         # next check for the input pure state of the system
         match = re.findall(r"^input?[ ]*=?[ ]*([\[\d\],\. ]+)", line)
         if len(match):
@@ -98,6 +126,13 @@ def parse(qc_file, debug=False):
             if debug: print(f"  input state {state}\n")
             continue
 
+        # check for the precision of the simulation
+        match = re.findall(r"^precision *=? *(single|double|complex64|complex128)", line)
+        if len(match):
+            options["precision"] = match[0]
+            if debug: print(f"  precision {match[0]}\n")
+            continue
+
         # now check for any classical function description
         match = re.findall(r"function *=?(.*)", line)
         if len(match):
@@ -112,6 +147,18 @@ def parse(qc_file, debug=False):
             layers.append(layer)
             continue
 
+        # check for the most likely states or those above a threshold
+        match = re.findall(r"prob *top *=? *(\d+)", line)
+        if len(match):
+            measurements.append(("top", int(match[0])))
+            if debug: print(f"  top {match[0]} prob query\n")
+            continue
+        match = re.findall(r"prob *> *([\d\.eE+-]+)", line)
+        if len(match):
+            measurements.append(("threshold", float(match[0])))
+            if debug: print(f"  prob > {match[0]} query\n")
+            continue
+
         # check for measurements of probabilities of the final state
         match = re.findall(r"prob *([n=]+\d+|[x01]*)", line)
         if len(match):
@@ -128,6 +175,13 @@ def parse(qc_file, debug=False):
             if debug: print(f" measure {match[0]} times\n")
             continue
 
+        # check for a dump of all the probabilities to a .npy file
+        match = re.findall(r"dump *(\S+)", line)
+        if len(match):
+            measurements.append(("dump", match[0]))
+            if debug: print(f"  dump probabilities to {match[0]}\n")
+            continue
+
         # check for a probability graph query
         match = re.findall(r"graph",line)
         if len(match):
@@ -141,6 +195,8 @@ def parse(qc_file, debug=False):
     if num_qbits == 0:
         print("ERROR: Number of qbits unspecified - Aborting.")
         return
+    if batch:
+        state = parse_inputs(batch, num_qbits)
     if not state:
         state = "0"*num_qbits       # default to all zero inputs
     if not function:
@@ -158,7 +214,7 @@ def parse(qc_file, debug=False):
             print(query)
         print()
 
-    return qbits, state, function, layers, measurements
+    return qbits, state, function, layers, measurements, options
 
 
 if __name__ == "__main__":
@@ -181,6 +237,7 @@ if __name__ == "__main__":
     function = circuit_info[2]
     layers = circuit_info[3]
     measurements = circuit_info[4]
+    options = circuit_info[5]
 
     print(f"qbits: {len(qbits)}\n  {qbits}\n")
     print(f"input state: {state}\n")
@@ -192,4 +249,5 @@ if __name__ == "__main__":
     print(f"measuements:")
     for m in measurements:
         print(f"  {m}")
+    print(f"options: {options}")
     print()
@@ -7,23 +7,51 @@ Clay Bell, Kentaro Yasuda
 12/8/2022
 """
 
+import os
 import sys
 import re
 import cProfile, pstats
+from math import log2
+from numpy import array, ascontiguousarray, complex64, complex128
+from numpy.random import default_rng
 
 from qparser import parse
-from qoperator import operator
+import qengine
+from qengine import gate
 from qstate import qstate, measure
+from qstabilizer import stabilizer
+from qmps import mps
+from qdist import dstate
+from qdisk import mstate
+from qfactor import fstate, partition
+from qoptimize import optimize, prune, relabel, fuse, fold
+from qcache import lrucache, diskcache
 from f import *
 
 
 DEBUG = False
 PROFILE = False
+PRECISION = None        # single or double (from the .qc file or double if None)
+SEED = None             # seed for measurements (random if None)
+BACKEND = None          # statevector, factored, stabilizer, mps, ... (picked if None)
+CHI = None              # largest MPS bond dimension (None for no cap)
+CUTOFF = 1e-12          # MPS singular value weight truncation threshold
+OPTIMIZE = True         # run the peephole optimizer before simulating
+PRUNE = True            # only simulate the light cone of the measured qbits
+FUSE = 4                # largest # of qbits of fused gates (0 to not fuse)
+FOLD = 20               # largest # of qbits of folded diagonal gates
+BLOCK = 2**26           # bytes of the disk backend's state held in memory
+DISKDIR = None          # directory of the disk backend's state file (temp dir if None)
+WORKERS = 2**int(log2(os.cpu_count() or 1))   # processes of the distributed backend
+LAYERS = lrucache(sizeof=lambda layer: sum(g.nbytes for g in layer))  # constructed layers by signature (256 MB)
+COMPILED = diskcache(os.path.join(os.path.expanduser("~"), ".cache", "qsim"))
+CACHE = True            # reuse compiled circuits saved in COMPILED
+COMPILER = ("qsim", "qparser", "qengine", "qoperator", "qoptimize", "qstabilizer", "qfactor", "qcache")  # sources in the COMPILED keys
 
 
 def construct_layer(layer, qbits, cf):
     """
-    Create the matrix representation of the given layer.
+    Create the list of gates making up the given layer.
 
     layer:
       [[operator1, [input qbits], [control bits]], [operator2, [...], [...]]]
@@ -36,82 +64,65 @@ def construct_layer(layer, qbits, cf):
       control function (classical binary function)
       used to construct Uf
 
-    ASSUMPTIONS:
-        1. layer with multiple gates contain no control bits
-        2. Uf unitaries operate on adjacent qbit blocks
-    """
-    # list of operators on this layer (default to nothing)
-    operators = ["I" for _ in range(len(qbits))]
-
-    # first parse out any special cases: control or Uf
-    if len(layer) == 1:
-        element = layer[0]
-        # unitary function: can now be controlled or part of layer
-        # assumption: Uf is continuous block
-        if element[0].upper() == "UF":
-            bits = sorted([qbits[x] for x in element[1]])
-            control = [qbits[x] for x in element[2]]
-            Uf = operator.UnitaryF(len(bits), cf)
-            # if controlled, ends up being whole layer
-            if len(control):
-                Uf = operator.Control(Uf, len(qbits), bits[0], control)
-                return Uf
-            # otherwise need to tensor w Is where Uf is not
-            else:
-                I1 = operator("I", bits[0])
-                I2 = operator("I", len(qbits)-bits[-1]-1)
-                return operator.tensor(I1, Uf, I2)
-
-        # controlled gate: must be whole layer
-        # one input for control gates only
-        if len(element[2]) > 0:
-            OP = operator(element[0])
-            qinput = qbits[element[1][0]]               # 1 bit input
-            control = [qbits[x] for x in element[2]]
-            return operator.Control(OP, len(qbits), qinput, control)
-
-    # run through each element and add to the operators
+    Single bit gates listed on several inputs become one gate per
+    input (each with the same controls), SWAP takes its inputs in pairs
+    and H stays a single gate over all of its inputs. Pf is the phase
+    oracle of f over its inputs (no output bit).
+
+    Uf and Pf act on their inputs in the order listed, which can be any
+    qbits: f sees the bits of x in that order and Uf writes f(x) to the
+    last one. The gate is applied over those axes of the state, so no
+    SWAPs or permutation of the register are needed.
+    """
+    gates = list()
     for element in layer:
-        qinput = element[1]
-        for line in qinput:
-            operators[qbits[line]] = element[0]
-
-    # condense the operator list down to neccessary ones
-    i = 0
-    neccessary = list()
-    while i < len(operators):
-        name = operators[i]
-        if name in ("I", "NOT", "H", "SWAP"):
-            j = 1
-            while i+j < len(operators) and operators[i+j] == name:
-                j += 1
-            neccessary.append((name, j))
-            i += j
+        name = element[0]
+        inputs = [qbits[x] for x in element[1]]
+        control = [qbits[x] for x in element[2]]
+
+        # unitary function: x is every input but the last, which gets f(x)
+        if name.upper() == "UF":
+            gates.append(gate.UnitaryF(inputs, cf, control))
+        elif name.upper() == "PF":
+            gates.append(gate.PhaseF(inputs, cf, control))
+        elif name == "H":
+            gates.append(gate(name, inputs, control))
+        elif name == "SWAP":
+            for i in range(0, len(inputs) - 1, 2):
+                gates.append(gate(name, inputs[i:i+2], control))
         else:
-            neccessary.append((name, 1))
-            i += 1
-    
-    # now construct the tensor product of the operators
-    LAYER = operator("I", 0)
-    for line in range(len(neccessary)):
-        op = neccessary[line][0]
-        n = neccessary[line][1]
-        LAYER = LAYER.tensor( operator(op, n) )
-    return LAYER
+            for qinput in inputs:
+                gates.append(gate(name, [qinput], control))
+    return gates
 
 
-def construct_operator(circuit, qbits, cf):
+def layer_signature(layer, qbits, f):
+    """
+    Key identifying a parsed layer: its gates with their input and
+    control bits, the number of qbits and, for layers with a Uf or Pf,
+    f (the function expression, or the object itself which the key
+    then keeps alive so no later f can be mistaken for it).
     """
-    Creates the quantum operator corresponding to a given quantum
+    gates = tuple((e[0], tuple(qbits[x] for x in e[1]), tuple(qbits[x] for x in e[2])) for e in layer)
+    oracle = any(e[0].upper() in ("UF", "PF") for e in layer)
+    return (gates, len(qbits), f if oracle else None)
+
+
+def construct_operator(circuit, qbits, cf, function=None):
+    """
+    Creates the list of gates corresponding to a given quantum
     circuit specified with a set number of bits and (optionally)
     a classical boolean function f(x) implemented as operator Uf.
 
-    NOTE: any layer w/ multiple controlled gates is constructed separately
-
     circuit:
         list of layers: [[operator, [bits], [control bits]], ... ]
     qbits:
         number of bits in the circuit input and output
+    function:
+        the expression cf was made from (keys the cached Uf layers)
+
+    Returns a list of layers, each a list of qengine gates which
+    act on distinct qbits and are applied one after the other.
     """
     if DEBUG:
         print("Circuit to Construct:")
@@ -119,39 +130,152 @@ def construct_operator(circuit, qbits, cf):
             print(f"  {l}")
         print(f"Qbits: {len(qbits)} {qbits}\n")
 
-    # split any layers with multiple control or Uf circuits up
-    i = 0
-    while i < len(circuit):
-        if not isinstance(circuit[i][0], str):     # multiple gates on layer
-            # check if any are controlled or Uf
-            UorCont = False
-            for sublayer in circuit[i]:
-                if sublayer[0].upper() == "UF" or len(sublayer[2]) > 0:
-                    UorCont = True
-                    break
-            # if so split the layer up into its components
-            if UorCont:
-                layer = circuit.pop(i)
-                for sublayer in reversed(layer):
-                    circuit.insert(i, [sublayer])
-        i += 1
-    if DEBUG:
-        print("Post Split Circuit:")
-        for l in circuit:
-            print(f"  {l}")
-
-    # construct the layers one by one
-    CIRCUIT = [construct_layer(l, qbits, cf) for l in circuit]
+    # construct the layers one by one, reusing any seen before
+    CIRCUIT = list()
+    for l in circuit:
+        key = layer_signature(l, qbits, cf if function is None else function)
+        layer = LAYERS.get(key)
+        if layer is None:
+            layer = construct_layer(l, qbits, cf)
+            LAYERS.put(key, layer)
+        CIRCUIT.append(layer)
     
     if DEBUG:
         print(f"Final Circuit:")
         for c in CIRCUIT:
-            print(c)
+            print(f"  {c}")
+        print(f"Layer cache: {LAYERS}\n")
 
     return CIRCUIT
 
 
-def main(filename):
+def measured_qbits(measurements, n):
+    """
+    Qbits read by the measurements: the top k for prob n=k, the fixed
+    bits of a prob pattern and all n of them for anything else.
+    """
+    qbits = set()
+    for m in measurements:
+        if m[0] == "prob" and isinstance(m[1], int):
+            qbits.update(range(min(m[1], n)))
+        elif m[0] == "prob" and m[1] != "all":
+            qbits.update(j for j in range(min(len(m[1]), n)) if m[1][j] != "x")
+        else:
+            return set(range(n))
+    return qbits
+
+
+def light_cone(circuit, qbits, state, measurements):
+    """
+    Cuts the constructed circuit down to the light cone of the
+    measured qbits (see qoptimize.prune). The input is a product state,
+    so qbits outside the cone never get entangled with the measured
+    ones and are traced out: they are dropped from the register, the
+    input state and the measurement patterns.
+
+    Returns the new circuit, qbits, state and measurements and a report
+    {"qbits": (before, after), "gates": (before, after)}.
+    """
+    n = len(qbits)
+    circuit, cone, gates = prune(circuit, measured_qbits(measurements, n))
+    inputs = [re.findall(r"(\[[\d\., ]+\]|[01])", s) for s in (state if isinstance(state, list) else [state])]
+    if not cone or len(cone) == n or any(len(i) != n for i in inputs):
+        return circuit, qbits, state, measurements, {"qbits": (n, n), "gates": gates}
+
+    # renumber the qbits of the cone from 0 (their order is kept)
+    axis = {cone[i]: i for i in range(len(cone))}
+    circuit = [[g.moved(axis) for g in layer] for layer in circuit]
+    qbits = {name: axis[q] for name, q in qbits.items() if q in axis}
+    inputs = ["".join(i[q] for q in cone) for i in inputs]
+    state = inputs if isinstance(state, list) else inputs[0]
+    measurements = [(m[0], "".join(m[1][q] if q < len(m[1]) else "x" for q in cone))
+                    if m[0] == "prob" and isinstance(m[1], str) and m[1] != "all" else m
+                    for m in measurements]
+    return circuit, qbits, state, measurements, {"qbits": (n, len(cone)), "gates": gates}
+
+
+def choose_backend(circuit, state):
+    """
+    Picks the simulation backend for the constructed circuit.
+
+    Circuits of only Clifford gates on a stabilizer input state are
+    simulated with a stabilizer tableau unless BACKEND says otherwise.
+    Circuits which leave the qbits in more than one cluster (see
+    qfactor.partition) keep them factored, the rest use the
+    statevector. A batch of input states (a list) always uses the
+    statevector.
+    """
+    backend = BACKEND
+    if isinstance(state, list):
+        if backend not in (None, "statevector"):
+            print(f"Batched inputs are simulated with the statevector backend, not {backend}\n")
+        backend = "statevector"
+    elif backend is None and stabilizer.supports(circuit, state):
+        backend = "stabilizer"
+    elif backend is None:
+        n = len(re.findall(r"(\[[\d\., ]+\]|[01])", state))
+        backend = "factored" if len(partition(circuit, n)) > 1 else "statevector"
+    if DEBUG:
+        print(f"Backend: {backend}\n")
+    return backend
+
+
+def precision(options):
+    """
+    Complex dtype of the amplitudes: PRECISION if given on the command
+    line, else the precision directive of the .qc file, else double.
+    """
+    name = PRECISION or options.get("precision", "double")
+    return complex64 if name in ("single", "complex64") else complex128
+
+
+def initial_state(backend, state, dtype=complex128):
+    """
+    Returns the input state in the given backend, ready to have the
+    gates applied. A batch of inputs becomes one qstate whose
+    statevector is a 2^n x B array with a column per input.
+
+    dtype is the complex precision of statevector amplitudes.
+    """
+    if isinstance(state, list):
+        batch = array([qstate(s).state for s in state], dtype=dtype).T
+        return qstate(ascontiguousarray(batch), norm=False)
+    if backend == "stabilizer":
+        return stabilizer(state)
+    if backend == "mps":
+        return mps(state, CHI, CUTOFF)
+    if backend == "distributed":
+        return dstate(state, WORKERS, dtype)
+    if backend == "disk":
+        return mstate(state, BLOCK // array(0, dtype).itemsize, DISKDIR, dtype)
+    if backend == "factored":
+        return fstate(state, dtype)
+    return qstate(state, norm=False, dtype=dtype)
+
+
+def simulate(circuit, PHI):
+    """
+    Applies each gate of the constructed circuit to the state PHI
+    (in place) and returns the final state. The disk backend applies
+    the whole circuit at once so it can group gates into passes.
+    """
+    if isinstance(PHI, mstate):
+        PHI.run(circuit)
+        return PHI
+    for layer in circuit:
+        for g in layer:
+            PHI.apply(g)
+    return PHI
+
+
+def compile_circuit(filename):
+    """
+    Parses the .qc file and builds the optimized gates of its circuit.
+
+    Returns (info, circuit) where info holds the qbits, input state,
+    measurements, backend, optimizer and light cone reports, and
+    circuit is the list of layers of gates ready to be simulated.
+    """
     # 2. parse the .qc file and get the qbits and layers of the circuit
     # NOTE: need way to input arbitrary [alpha, beta] qbit state
     circuit_info = parse(filename)
@@ -160,6 +284,7 @@ def main(filename):
     function = circuit_info[2]
     layers = circuit_info[3]
     measurements = circuit_info[4]
+    options = circuit_info[5]
     if DEBUG:
         print(f"qbits:\n  {qbits}\n")
         print(f"input state: {state}\n")
@@ -177,21 +302,146 @@ def main(filename):
     # initialize the function
     cf = eval(function)
 
-    # construct the operator that represents the circuit
-    OPs = construct_operator(layers, qbits, cf)
+    # construct the gates that make up the circuit
+    OPs = construct_operator(layers, qbits, cf, function.strip())
+
+    # only simulate the gates and qbits the measurements depend on
+    cone = None
+    inputs = state          # as given, to label the results of batches
+    if PRUNE and measurements:
+        OPs, qbits, state, measurements, cone = light_cone(OPs, qbits, state, measurements)
+        if DEBUG:
+            print(f"Light cone: qbits {list(qbits.values())}, measurements {measurements}\n")
+    backend = choose_backend(OPs, state)
+
+    # simplify the circuit (merged gates are not Clifford gates)
+    report = None
+    if OPTIMIZE:
+        OPs, report = optimize(OPs, merge=backend != "stabilizer")
+
+    # SWAPs only relabel qbits, so take them out of the way of fusion
+    if backend in ("statevector", "distributed", "disk", "factored"):
+        OPs = relabel(OPs)
+
+    # fuse runs of gates on a few qbits into one sweep of the state
+    # (not when factored, fused gates would merge separate clusters)
+    if FUSE and backend in ("statevector", "distributed", "disk"):
+        passes = sum(len(l) for l in OPs)
+        OPs = fuse(OPs, FUSE)
+        if DEBUG:
+            print(f"Fused {passes} gates into {sum(len(l) for l in OPs)} (up to {FUSE} qbits each)\n")
+
+    # fold runs of diagonal gates into one multiply by their phases
+    if backend in ("statevector", "distributed", "disk"):
+        limit = FOLD
+        if backend == "disk":
+            amplitudes = BLOCK // array(0, precision(options)).itemsize
+            limit = min(limit, max(1, int(amplitudes).bit_length() - 1))
+        elif backend == "distributed":
+            limit = min(limit, len(qbits) - min(int(log2(WORKERS)), len(qbits) - 1))
+        OPs, folded = fold(OPs, limit)
+        if DEBUG and folded:
+            print(f"Folded {folded} diagonal gates into the phases of their neighbours\n")
+
+    info = {"qbits": qbits, "state": state, "measurements": measurements,
+            "backend": backend, "report": report, "cone": cone, "options": options,
+            "inputs": inputs}
+    return info, OPs
+
+
+def circuit_key(filename):
+    """
+    Key of the compiled circuit in COMPILED: hash of the .qc file, the
+    source of f.py, the source of the simulator modules which compile
+    it (so changes to them don't load stale circuits) and the options
+    changing what gets compiled (BLOCK, PRECISION and WORKERS limit
+    the folded gates).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    files = [filename, sys.modules["f"].__file__] + [os.path.join(here, m + ".py") for m in COMPILER]
+    sources = list()
+    for name in files:
+        with open(name, "rb") as src:
+            sources.append(src.read())
+    return diskcache.key(*sources, OPTIMIZE, PRUNE, FUSE, BACKEND, BLOCK, PRECISION, WORKERS)
+
+
+def main(filename):
+    # reuse the compiled circuit of an earlier run if nothing changed
+    key = circuit_key(filename) if CACHE else None
+    cached = COMPILED.load(key) if CACHE else None
+    if cached is None:
+        info, OPs = compile_circuit(filename)
+        if CACHE:
+            COMPILED.save(key, info, OPs)
+    else:
+        info, OPs = cached
+        if DEBUG:
+            print(f"Loaded compiled circuit from {COMPILED.file(key)}\n")
+    state = info["state"]
+    measurements = info["measurements"]
+    backend = info["backend"]
+    report = info["report"]
+    cone = info.get("cone")
+
+    if cone and (cone["qbits"][0] != cone["qbits"][1] or cone["gates"][0] != cone["gates"][1]):
+        print("Light Cone: removed {} of {} qbits and {} of {} gates outside the cone of the measured qbits\n".format(
+            cone["qbits"][0] - cone["qbits"][1], cone["qbits"][0],
+            cone["gates"][0] - cone["gates"][1], cone["gates"][0]))
+    if report and report["gates"][0] != report["gates"][1]:
+        print("Optimized Circuit: removed {} of {} layers and {} of {} gates "
+              "({} cancelled, {} merged, {} identities)\n".format(
+            report["layers"][0] - report["layers"][1], report["layers"][0],
+            report["gates"][0] - report["gates"][1], report["gates"][0],
+            report["cancelled"], report["merged"], report["identities"]))
 
     # get the input quantum pure state
-    PSI = qstate(state)
+    dtype = precision(info.get("options", dict()))
+    if DEBUG:
+        print(f"Precision: {dtype.__name__}\n")
+    PSI = initial_state(backend, state, dtype)
+    try:
+        if isinstance(state, list):
+            if len(measurements): print(f"Input States: {len(state)} inputs\n")
+        elif len(measurements) and cone and cone["qbits"][0] != cone["qbits"][1]:
+            # only the qbits of the light cone are simulated, so name them
+            names = " ".join(sorted(info["qbits"], key=info["qbits"].get))
+            print(f"Input State of {names}: {PSI}\n")
+        elif len(measurements): print(f"Input State: {PSI}\n")
 
-    # 4. apply the circuit to the input state to get the final state
-    PHI = PSI
-    for OP in OPs:
-        PHI = OP * PHI
+        # 4. apply the circuit to the input state to get the final state
+        PHI = simulate(OPs, PSI)
 
-    # 5. take any measurements requested from the final state
-    if len(measurements): print(f"Input State: {PSI}\n")
-    for m in measurements:
-        measure(PHI, m, 10)
+        # 5. take any measurements requested from the final state
+        rng = default_rng(SEED)
+        if isinstance(state, list):
+            # the batch is dumped as a whole, the rest is reported per input
+            for m in measurements:
+                if m[0] == "dump":
+                    measure(PHI, m, 10, rng)
+            for i in range(len(state)):
+                print(f"Input {info.get('inputs', state)[i]}:")
+                phi = qstate(PHI.state[:, i], norm=False)
+                for m in measurements:
+                    if m[0] != "dump":
+                        measure(phi, m, 10, rng)
+                print()
+            return
+        if isinstance(PHI, dstate):
+            print(f"Distributed over {2**PHI.g} workers with {PHI.exchanges} global qbit exchanges\n")
+            PHI = PHI.gather()
+        for m in measurements:
+            measure(PHI, m, 10, rng)
+        if isinstance(PHI, mstate):
+            print(f"Applied the circuit in {PHI.passes} passes over {PHI.file}")
+        if isinstance(PHI, fstate):
+            print(f"Kept {PHI.bits} qbits in {len(PHI.clusters)} clusters, the largest of {PHI.largest} qbits")
+        if isinstance(PHI, mps):
+            print(f"MPS truncation error: {PHI.error:.3e} (bond dimension {PHI.bond})")
+    finally:
+        # free the shared memory / state file even if a measurement fails
+        if isinstance(PSI, (dstate, mstate)):
+            PSI.close()
 
 if __name__ == "__main__":
     # 1. parse the program args and setup env variables
@@ -206,6 +456,48 @@ if __name__ == "__main__":
             DEBUG = True
         if re.match(r"stats|profile", sys.argv[i].lower()):
             PROFILE = True
+        if re.match(r"noopt", sys.argv[i].lower()):
+            OPTIMIZE = False
+        if re.match(r"noprune", sys.argv[i].lower()):
+            PRUNE = False
+        if re.match(r"nocache", sys.argv[i].lower()):
+            CACHE = False
+        match = re.findall(r"^cachedir=(.+)", sys.argv[i])
+        if len(match):
+            COMPILED.path = match[0]
+        match = re.findall(r"^precision=(single|double|complex64|complex128)", sys.argv[i].lower())
+        if len(match):
+            PRECISION = match[0]
+        match = re.findall(r"^seed=(\d+)", sys.argv[i].lower())
+        if len(match):
+            SEED = int(match[0])
+        match = re.findall(r"^backend=(statevector|factored|stabilizer|mps|distributed|disk)", sys.argv[i].lower())
+        if len(match):
+            BACKEND = match[0]
+        match = re.findall(r"^cache=(\d+)", sys.argv[i].lower())
+        if len(match):
+            LAYERS.budget = int(match[0]) * 2**20
+        match = re.findall(r"^fuse=(\d+)", sys.argv[i].lower())
+        if len(match):
+            FUSE = int(match[0])
+        match = re.findall(r"^threads=(\d+)", sys.argv[i].lower())
+        if len(match):
+            qengine.THREADS = max(1, int(match[0]))
+        match = re.findall(r"^block=(\d+)", sys.argv[i].lower())
+        if len(match):
+            BLOCK = int(match[0]) * 2**20
+        match = re.findall(r"^diskdir=(.+)", sys.argv[i])
+        if len(match):
+            DISKDIR = match[0]
+        match = re.findall(r"^workers=(\d+)", sys.argv[i].lower())
+        if len(match):
+            WORKERS = int(match[0])
+        match = re.findall(r"^chi=(\d+)", sys.argv[i].lower())
+        if len(match):
+            CHI = int(match[0])
+        match = re.findall(r"^cutoff=([\d\.e-]+)", sys.argv[i].lower())
+        if len(match):
+            CUTOFF = float(match[0])
     
     # can run the simulation in profile mode or normally
     if PROFILE:
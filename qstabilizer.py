@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""
+Stabilizer (Clifford) simulation of quantum circuits.
+
+Circuits made only of H, NOT, PAULIz, SWAP and singly controlled
+NOT / PAULIz gates keep the state a stabilizer state, which can be
+stored as a tableau of 2n Pauli operators (Aaronson and Gottesman,
+"Improved Simulation of Stabilizer Circuits") instead of 2^n
+amplitudes. Gates cost O(n) and measurements at most O(n^3), so
+circuits with thousands of qbits can be simulated.
+
+The stabilizer class answers the same measurement queries as qstate
+so it can be handed straight to qstate.measure.
+"""
+
+import re
+from numpy import zeros, eye, arange, array, flatnonzero, unique, int8, int64, float64, packbits, concatenate
+from numpy.linalg import norm
+from numpy.random import default_rng
+
+from qstate import qstate
+
+
+def rowsum(x, z, r, xi, zi, ri):
+    """
+    Multiplies the Pauli rows (x, z, r) on the left by the single
+    Pauli row (xi, zi, ri), tracking the sign. Returns the new rows.
+
+    x, z are boolean arrays with one row per Pauli, r the sign bits
+    (1 for a -1 sign).
+    """
+    x1, z1 = xi.astype(int8), zi.astype(int8)
+    x2, z2 = x.astype(int8), z.astype(int8)
+
+    # exponent of i picked up by multiplying each single qbit Pauli
+    g = (x1 & z1) * (z2 - x2) \
+        + (x1 & (1 - z1)) * z2 * (2*x2 - 1) \
+        + ((1 - x1) & z1) * x2 * (1 - 2*z2)
+    phase = (2*r.astype(int64) + 2*int(ri) + g.sum(axis=-1, dtype=int64)) % 4
+    return x ^ xi, z ^ zi, phase == 2
+
+
+def gf2_rref(M):
+    """
+    Reduced row echelon form of the boolean matrix M over GF(2).
+    Returns the nonzero rows and the pivot column of each.
+    """
+    M = M.copy()
+    pivots = list()
+    row = 0
+    for col in range(M.shape[1]):
+        if row == len(M):
+            break
+        hits = flatnonzero(M[row:, col])
+        if not len(hits):
+            continue
+        p = row + hits[0]
+        M[[row, p]] = M[[p, row]]
+        others = flatnonzero(M[:, col])
+        others = others[others != row]
+        M[others] ^= M[row]
+        pivots.append(col)
+        row += 1
+    return M[:row], pivots
+
+
+def in_span(R, pivots, v):
+    """ checks if v is in the row space of the reduced rows R """
+    v = v.copy()
+    for i in range(len(pivots)):
+        if v[pivots[i]]:
+            v ^= R[i]
+    return not v.any()
+
+
+def to_index(bits):
+    """
+    Basis indices of rows of bits (top bit first). Python ints so
+    registers wider than 64 bits still work.
+    """
+    n = bits.shape[1]
+    if n <= 62:
+        return (bits.astype(int64) @ (1 << arange(n-1, -1, -1, dtype=int64))).tolist()
+    pad = (-n) % 8
+    packed = packbits(concatenate([zeros((len(bits), pad), dtype=bool), bits], axis=1), axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in packed]
+
+
+class stabilizer:
+    """
+    Stabilizer state of n qbits stored as a tableau.
+
+    Rows 0..n-1 are the destabilizers and rows n..2n-1 the stabilizers
+    of the state, each a Pauli operator given by its X bits, Z bits
+    and sign bit r.
+
+    state is an input string as in qstate where every qbit is 0, 1
+    or an equal superposition [a,a] (|+〉).
+    """
+    def __init__(self, state="0"):
+        qbits = stabilizer.parse_input(state)
+        n = len(qbits)
+        self.n = n
+        self.x = zeros((2*n, n), dtype=bool)
+        self.z = zeros((2*n, n), dtype=bool)
+        self.r = zeros(2*n, dtype=bool)
+        self.x[:n] = eye(n, dtype=bool)
+        self.z[n:] = eye(n, dtype=bool)
+        for i in range(n):
+            if qbits[i] == "1":
+                self.r[n+i] = True
+            elif qbits[i] == "+":
+                self.h(i)
+        self._affine = None
+
+    def __str__(self):
+        if self.n <= 16:
+            return str(qstate(self.state, norm=False))
+        if self.n > 64:
+            return f"stabilizer state of {self.n} qbits with 2^{len(self.affine[1])} equally likely outcomes"
+        paulis = list()
+        for i in range(self.n, 2*self.n):
+            s = "-" if self.r[i] else "+"
+            for j in range(self.n):
+                s += "IXZY"[self.x[i, j] + 2*self.z[i, j]]
+            paulis.append(s)
+        return "〈" + ", ".join(paulis) + "〉"
+
+    def __len__(self):
+        return 2**self.n
+
+    @property
+    def bits(self):
+        return self.n
+
+    @staticmethod
+    def parse_input(state):
+        """
+        Reads an input string into a list of "0", "1" and "+" per qbit.
+        Returns None if some qbit is not a stabilizer state.
+        """
+        qbits = list()
+        for m in re.findall(r"(\[[\d\., ]+\]|[01])", state):
+            if m in ("0", "1"):
+                qbits.append(m)
+                continue
+            alpha, beta = (float(a) for a in m[1:-1].split(','))
+            if beta == 0:
+                qbits.append("0")
+            elif alpha == 0:
+                qbits.append("1")
+            elif alpha == beta:
+                qbits.append("+")
+            else:
+                return None
+        return qbits
+
+    @staticmethod
+    def supports(circuit, state):
+        """
+        Checks if the constructed circuit (layers of qengine gates)
+        only uses Clifford gates and the input is a stabilizer state.
+        """
+        if stabilizer.parse_input(state) is None:
+            return False
+        for layer in circuit:
+            for g in layer:
+                if g.name == "I":
+                    continue
+                if g.name == "H" and not g.controls:
+                    continue
+                if g.name in ("NOT", "S", "PAULIz") and len(g.controls) <= 1:
+                    continue
+                if g.name == "SWAP" and not g.controls:
+                    continue
+                return False
+        return True
+
+    def h(self, a):
+        """ Hadamard on qbit a """
+        self.r ^= self.x[:, a] & self.z[:, a]
+        self.x[:, a], self.z[:, a] = self.z[:, a].copy(), self.x[:, a].copy()
+
+    def cnot(self, a, b):
+        """ NOT on qbit b controlled by qbit a """
+        self.r ^= self.x[:, a] & self.z[:, b] & ~(self.x[:, b] ^ self.z[:, a])
+        self.x[:, b] ^= self.x[:, a]
+        self.z[:, a] ^= self.z[:, b]
+
+    def apply(self, g):
+        """
+        Applies a qengine gate to the tableau (must be Clifford).
+        """
+        self._affine = None
+        if g.name == "I":
+            return
+        elif g.name == "H" and not g.controls:
+            for t in g.targets:
+                self.h(t)
+        elif g.name in ("NOT", "S") and not g.controls:
+            for t in g.targets:
+                self.r ^= self.z[:, t]
+        elif g.name in ("NOT", "S") and len(g.controls) == 1:
+            for t in g.targets:
+                self.cnot(g.controls[0], t)
+        elif g.name == "PAULIz" and not g.controls:
+            for t in g.targets:
+                self.r ^= self.x[:, t]
+        elif g.name == "PAULIz" and len(g.controls) == 1:
+            for t in g.targets:
+                self.h(t)
+                self.cnot(g.controls[0], t)
+                self.h(t)
+        elif g.name == "SWAP" and not g.controls:
+            a, b = g.targets
+            self.x[:, [a, b]] = self.x[:, [b, a]]
+            self.z[:, [a, b]] = self.z[:, [b, a]]
+        else:
+            raise ValueError(f"{g} is not a Clifford gate")
+
+    @property
+    def affine(self):
+        """
+        Measuring every qbit of a stabilizer state gives outcomes
+        spread uniformly over an affine space x0 + span(V).
+
+        V comes from the X parts of the stabilizers once they are in
+        row echelon form, the remaining (pure Z) stabilizers give the
+        linear equations z . x = r that fix x0.
+        """
+        if self._affine is not None:
+            return self._affine
+        n = self.n
+        x, z, r = self.x[n:].copy(), self.z[n:].copy(), self.r[n:].copy()
+
+        # row echelon form of the X parts, multiplying the stabilizers
+        row = 0
+        for col in range(n):
+            hits = flatnonzero(x[row:, col])
+            if not len(hits):
+                continue
+            p = row + hits[0]
+            for a in (x, z, r):
+                a[[row, p]] = a[[p, row]]
+            others = flatnonzero(x[:, col])
+            others = others[others != row]
+            x[others], z[others], r[others] = rowsum(x[others], z[others], r[others], x[row], z[row], r[row])
+            row += 1
+            if row == n:
+                break
+        V = x[:row]
+
+        # solve the pure Z stabilizers for one outcome x0
+        R, pivots = gf2_rref(concatenate([z[row:], r[row:, None]], axis=1))
+        x0 = zeros(n, dtype=bool)
+        for i in range(len(pivots)):
+            x0[pivots[i]] = R[i, -1]
+        self._affine = (x0, V)
+        return self._affine
+
+    @property
+    def state(self):
+        """
+        Statevector of the state (only sensible for few qbits), found
+        by projecting a basis state of the support onto every
+        stabilizer: |ψ〉 ∝ Π (I + S)/2 |x0〉.
+        """
+        n = self.n
+        index = arange(2**n)
+        psi = zeros(2**n, dtype=complex)
+        psi[to_index(self.affine[0][None, :])[0]] = 1
+        for i in range(n, 2*n):
+            xmask, zmask = to_index(self.x[i:i+1])[0], to_index(self.z[i:i+1])[0]
+            parity = zeros(2**n, dtype=int64)
+            for b in range(n):
+                if zmask >> b & 1:
+                    parity ^= (index ^ xmask) >> b & 1
+            sign = (-1)**int(self.r[i]) * 1j**int((self.x[i] & self.z[i]).sum())
+            psi = (psi + sign * (-1)**parity * psi[index ^ xmask]) / 2
+        return psi / norm(psi)
+
+    def support(self, k):
+        """
+        Basis indices of the k lowest possible outcomes, in order. With
+        V in reduced row echelon form and x0 cleared on its pivots, the
+        outcome picked by the bits c of the rows has the bits c on the
+        pivots, so counting c up from 0 lists the outcomes in order.
+        """
+        x0, V = self.affine
+        R, pivots = gf2_rref(V)
+        x0 = x0.copy()
+        for i in range(len(pivots)):
+            if x0[pivots[i]]:
+                x0 ^= R[i]
+        k = min(k, 2**len(R))
+        combos = (arange(k)[:, None] >> arange(len(R)-1, -1, -1)) & 1
+        bits = (combos.astype(float64) @ R.astype(float64)) % 2 == 1
+        return to_index(bits ^ x0)
+
+    @property
+    def prob(self):
+        """ probabilities of pure states (only sensible for few qbits) """
+        prob = zeros(2**self.n)
+        prob[self.support(2**self.n)] = 2.0**(-len(self.affine[1]))
+        return prob
+
+    def sample(self, shots, rng=None):
+        """
+        Draws 'shots' measurements of the state without collapsing it,
+        as random points of the affine outcome space.
+
+        Returns a histogram {basis index: count} of the outcomes seen.
+        """
+        rng = default_rng(rng)
+        x0, V = self.affine
+        combos = rng.integers(0, 2, (shots, len(V))).astype(float64)
+        bits = (combos @ V.astype(float64)) % 2 == 1
+        bits, counts = unique(bits ^ x0, axis=0, return_counts=True)
+        return dict(zip(to_index(bits), counts.tolist()))
+
+    def joint_prob(self, pattern):
+        """
+        Probability of a measurement matching the pattern (see qstate),
+        either 0 or 2^-k where k is the rank of V on the fixed bits.
+        """
+        x0, V = self.affine
+        fixed = [j for j in range(len(pattern)) if pattern[j] != 'x']
+        value = array([pattern[j] == '1' for j in fixed], dtype=bool)
+        R, pivots = gf2_rref(V[:, fixed])
+        if not in_span(R, pivots, value ^ x0[fixed]):
+            return 0.0
+        return 2.0**(-len(pivots))
+
+    def marginal(self, top):
+        """
+        Probabilities of the pure states of the top 'top' bits, which
+        are uniform over the affine space restricted to those bits.
+        """
+        x0, V = self.affine
+        R, pivots = gf2_rref(V[:, :top])
+        combos = (arange(2**len(R))[:, None] >> arange(len(R)-1, -1, -1)) & 1
+        bits = (combos.astype(float64) @ R.astype(float64)) % 2 == 1
+        prob = zeros(2**top)
+        prob[to_index(bits ^ x0[:top])] = 2.0**(-len(R))
+        return prob
+
+    def top(self, k):
+        """ the k most likely pure states (all outcomes are equally likely) """
+        index = array(self.support(k), dtype=object)
+        return index, [2.0**(-len(self.affine[1]))] * len(index)
+
+    def above(self, threshold):
+        """
+        The pure states with probability > threshold: none or all of
+        them, refused when all of them are too many to list.
+        """
+        rank = len(self.affine[1])
+        if 2.0**(-rank) <= threshold:
+            return array([], dtype=object), []
+        if rank > 24:
+            raise ValueError(f"all 2^{rank} outcomes are above {threshold}, too many to list")
+        index = array(self.support(2**rank), dtype=object)
+        return index, [2.0**(-rank)] * len(index)
@@ -5,11 +5,13 @@ Defines the basic multi-bit quantum states.
 """
 
 from math import sqrt, log
-from numpy import array, ndarray, isclose, kron
+from numpy import array, ndarray, isclose, kron, zeros, float64, flatnonzero, arange, argpartition, argsort, sort, save
 from numpy.linalg import norm
-from random import random
+from numpy.random import default_rng
 import re
 
+from qengine import apply, reorder
+
 
 class qstate:
     """
@@ -22,20 +24,30 @@ class qstate:
       state="0", n=2    -->  |00〉
       state="010"       -->  |010〉
       state="010", n=2  -->  |010010〉
+
+    dtype fixes the precision of the amplitudes (e.g. complex64 or
+    complex128), otherwise it is whatever NumPy makes of the input.
+
+    SWAP gates don't move any amplitudes, they only swap the axes two
+    qbits are kept on (where). The statevector is put back in qbit
+    order the next time it is read.
     """
-    def __init__(self, state="0", n=1, norm=True):
+    def __init__(self, state="0", n=1, norm=True, dtype=None):
         self.norm = norm        # optimization reasons, to normalize or not
+        self.where = None       # axis of each qbit (None if in order)
         if isinstance(state, str) and n > 0:
             self.state = state * n
         else:
             self.state = state
+        if dtype is not None:
+            self._statevector = self._statevector.astype(dtype, copy=False)
 
     def __str__(self):
-        pure_states = qstate.pure_states(self.bits)
         string = ""
-        for i in range(len(pure_states)):
-            if self.state[i]:
-                string += "({:.3f})|{}〉+ ".format(self.state[i], pure_states[i])
+        for i in flatnonzero(self.state):
+            a = self.state[i]
+            a = a if a.imag else a.real         # drop zero imaginary parts
+            string += "({:.3f})|{:0{}b}〉+ ".format(a, i, self.bits)
         return string[:-2]
 
     def __add__(self, other):
@@ -64,21 +76,33 @@ class qstate:
     @staticmethod
     def pure_states(n):
         """ computes the pure states for n bits """
-        if n <= 1:
-            return ["0", "1"]
-        else:
-            zero = ["0"+x for x in qstate.pure_states(n-1)]
-            one = ["1"+x for x in qstate.pure_states(n-1)]
-            return zero + one
+        return [format(i, f"0{n}b") for i in range(2**max(n, 1))]
+
+    @staticmethod
+    def pattern(pattern, n):
+        """
+        Compiles a pattern such as 00x11 on the top bits of an n bit
+        state into a (mask, value) pair: basis state i matches the
+        pattern when i & mask == value.
+        """
+        mask = value = 0
+        for j in range(len(pattern)):
+            if pattern[j] != 'x':
+                mask |= 1 << (n-j-1)
+                value |= int(pattern[j]) << (n-j-1)
+        return mask, value
 
     @property
     def state(self):
+        if self.where is not None:
+            self._statevector = reorder(self._statevector, self.where)
+            self.where = None
         return self._statevector
   
     @property
     def prob(self):
         """ probabilities of pure states """
-        return [norm(x)**2 for x in self.state]
+        return abs(self.state)**2
 
     @property
     def bits(self):
@@ -120,6 +144,21 @@ class qstate:
         else:
             self._statevector = array([1, 0])     # default to |0〉
 
+    def apply(self, gate):
+        """
+        Applies a qengine gate to the state (see qengine.apply), SWAPs
+        just relabel the axes of their qbits.
+        """
+        if gate.name == "SWAP" and not gate.controls:
+            if self.where is None:
+                self.where = list(range(self.bits))
+            a, b = gate.targets
+            self.where[a], self.where[b] = self.where[b], self.where[a]
+            return
+        if self.where is not None:
+            gate = gate.moved(self.where)
+        self._statevector = apply(self._statevector, gate)
+
     def tensor(qs1, qs2, *args):
         """
         Computes tensor product between two states.
@@ -131,26 +170,35 @@ class qstate:
             vec = kron(vec, qsn.state)
         return qstate(vec, norm=False)
 
-    def measure(self):
+    def measure(self, rng=None):
         """
         Collapses state down into pure basis.
         Returns classical measurement of final state.
         """
-        # find list of probability partial sums
-        prob = self.prob
-        probs = [sum(prob[:i]) for i in range(1, len(prob)+1)]
+        (state, _), = self.sample(1, rng).items()
+        collapsed = zeros(len(self), dtype=self.state.dtype)
+        collapsed[state] = 1
+        self._statevector = collapsed       # collapse down to pure state
 
-        # get the uniform random variable
-        x = random()
+        return cstate(format(state, f"0{self.bits}b"))
 
-        # now find out which pure state this measurement corresponds to
-        state = 0
-        while probs[state] < x:
-            state += 1
-        statestr = self.pure_states(self.bits)[state]
-        self.state = statestr               # collapse down to pure state
+    def sample(self, shots, rng=None):
+        """
+        Draws 'shots' measurements of the state without collapsing it.
 
-        return cstate(statestr)
+        All shots are drawn at once as one multinomial sample over
+        the probabilities, rather than one random walk per shot.
+
+        rng - numpy Generator or seed (fresh entropy if None)
+
+        Returns a histogram {basis index: count} of the outcomes seen.
+        """
+        rng = default_rng(rng)
+        prob = self.prob.astype(float64)
+        counts = rng.multinomial(shots, prob / prob.sum())
+        index = flatnonzero(counts)
+        counts = counts[index]
+        return dict(zip(index.tolist(), counts.tolist()))
 
     def joint_prob(self, pattern):
         """
@@ -165,20 +213,38 @@ class qstate:
         ex) first 4 bits (of 5) have q2=1 and q4=1 rest any
           pattern: x1x1x
         """
-        probs = self.prob
-        pure_states = self.pure_states(self.bits)
-        total_prob = 0
-        for i in range(len(probs)):
-            state = pure_states[i]
-            match = True
-            for j in range(len(pattern)):
-                if pattern[j] != 'x' and pattern[j] != state[j]:
-                    match = False
-                    break
-            if match:
-                total_prob += probs[i]
-        return total_prob
-            
+        mask, value = qstate.pattern(pattern, self.bits)
+        index = arange(len(self))
+        return self.prob[index & mask == value].sum(dtype=float64)
+
+    def top(self, k):
+        """
+        The k most likely pure states (found with a partial sort).
+        Returns their basis indices, most likely first, and their
+        probabilities.
+        """
+        prob = self.prob
+        k = min(k, len(prob))
+        index = sort(argpartition(prob, len(prob)-k)[len(prob)-k:])
+        index = index[argsort(-prob[index], kind="stable")]
+        return index, prob[index]
+
+    def above(self, threshold):
+        """
+        Basis indices and probabilities of the pure states with
+        probability > threshold.
+        """
+        prob = self.prob
+        index = flatnonzero(prob > threshold)
+        return index, prob[index]
+
+    def marginal(self, top):
+        """
+        Probabilities of the pure states of the top 'top' bits, with
+        the remaining bits summed out.
+        """
+        return self.prob.reshape(2**top, -1).sum(axis=1, dtype=float64)
+
     @staticmethod
     def ZERO():
         """
@@ -194,6 +260,8 @@ class qstate:
         return ONE
 
 
+LISTED = 2**26         # most pure states a measurement lists, dumps or plots
+
 ZERO = qstate([1, 0])
 ONE = qstate([0, 1])
 
@@ -214,7 +282,7 @@ class cstate:
         return f"|{self.state}〉"
 
 
-def measure(phi, m, r=3):
+def measure(phi, m, r=3, rng=None):
     """
     Auxillary function used to measure qstates with easy to
     write parameters.
@@ -232,6 +300,15 @@ def measure(phi, m, r=3):
       ex. pattern = "000xx" - top 3 bits 0, others are any
       More examples in README.
 
+    m = ("top", k)
+      Measures probabilities of the k most likely pure states.
+
+    m = ("threshold", p)
+      Measures probabilities of pure states more likely than p.
+
+    m = ("dump", filename)
+      Saves all the probabilities to a .npy file.
+
     m = ("measure", n)
       Prints results of n measurements of final state.
 
@@ -239,43 +316,51 @@ def measure(phi, m, r=3):
       Shows a graph of the probabilities of the state.
 
     r is the number of digits to round.
+
+    rng is the numpy Generator (or seed) used to draw measurements.
+
+    Wide states (such as stabilizer states of 1000s of qbits) have too
+    many pure states to list or dump, those measurements are refused
+    with a message instead of running out of memory.
     """
+    top = m[1] if m[0] == "prob" and isinstance(m[1], int) else phi.bits
+    if m[0] in ("dump", "graph") or m[0] == "prob" and (isinstance(m[1], int) or m[1] == "all"):
+        if top > 62 or 2**top > LISTED:
+            print(f"Too many pure states (2^{top}) to list or dump, at most {LISTED}")
+            return
     if m[0] == "measure":
         print(f"Results of {m[1]} Measurements")
-        res = {s:0 for s in qstate.pure_states(phi.bits)}
-        for _ in range(m[1]):
-            PHIprime = qstate(phi.state)    # sorry no cloning thm :(
-            q = PHIprime.measure()
-            res[q.state] += 1
-        for qs in res.keys():
-            if res[qs] > 0:
-                print(f"  |{qs}〉--> {res[qs]}/{m[1]}")
+        res = phi.sample(m[1], rng)
+        for i in sorted(res):
+            print(f"  |{i:0{phi.bits}b}〉--> {res[i]}/{m[1]}")
     elif m[0] == "prob":
         if isinstance(m[1], int) or m[1] == "all":
             print("Probabilities of Pure State Measurements:")
-            bits = phi.bits
-            s = phi.pure_states(bits)
-            p = phi.prob
-            if isinstance(m[1], int):
-                top = m[1]
-                step = 2**(bits-top)
-            else:
-                top = bits
-                step = 1
-            for i in range(0, len(s), step):
-                prob_list = p[i:i+step]
-                print(f"  ({round(sum(prob_list), r)}) |{s[i][:top]}〉")
+            p = phi.marginal(top)
+            for i in range(len(p)):
+                print(f"  ({round(p[i], r)}) |{i:0{top}b}〉")
         else:
             #print(f"Probability of {m[1]} Measurement:")
             p = phi.joint_prob(m[1])
-            s = ""
-            s += m[1][1]
-            s += m[1][3]
-            s += m[1][5]
-            s += m[1][7]
-            s += m[1][9]
-
+            s = m[1].replace("x", "")        # only the bits fixed by the pattern
             print(f"  P[{s}] = {round(p, r)}")
+    elif m[0] in ("top", "threshold"):
+        # backends which can't search that many states refuse
+        try:
+            if m[0] == "top":
+                print(f"Probabilities of {m[1]} Most Likely Pure States:")
+                index, p = phi.top(m[1])
+            else:
+                print(f"Probabilities of Pure States Above {m[1]}:")
+                index, p = phi.above(m[1])
+        except ValueError as e:
+            print(f"  {e}")
+            return
+        for i in range(len(index)):
+            print(f"  ({round(p[i], r)}) |{index[i]:0{phi.bits}b}〉")
+    elif m[0] == "dump":
+        save(m[1], phi.prob)
+        print(f"Saved probabilities of {len(phi)} pure states to {m[1]}")
     elif m[0] == "graph":
         import matplotlib.pyplot as plt
         print("Plotting probabilities of states")
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Sweeps a circuit over many sets of arguments of its function f.
+
+The circuit of the .qc file is compiled once without its oracle: the
+layers between the Uf (or Pf) gates are constructed, optimized, fused
+and folded up front. Each job then only builds the oracles for its own
+f, runs the circuit and evaluates the measurements of the .qc file.
+Jobs run in a process pool and their results are written to a JSONL
+or CSV file as each one finishes.
+
+  qsweep.py circuit.qc grid.txt results.jsonl workers=8 seed=1
+
+Each line of grid.txt holds the arguments of one f, e.g. with
+function = grover(["100"]) in the .qc file the lines
+
+  ["000"]
+  ["001", "110"]
+
+run the circuit with grover(["000"]) and grover(["001", "110"]).
+"""
+
+import os
+import sys
+import re
+import csv
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from numpy.random import default_rng
+
+from qparser import parse
+from qstate import qstate
+from qoptimize import optimize, relabel, fuse, fold
+import qsim
+from f import *
+
+
+WORKERS = None          # # of processes (# of cores if None)
+SEED = None             # seed for measurements (random if None)
+PLAN = None             # compiled circuit shared by the jobs of a worker
+
+
+def compile_sweep(filename):
+    """
+    Compiles the circuit of the .qc file apart from its oracle.
+
+    Returns a dict with the qbits, input state, measurements, name of
+    the function, the 'segments' of gates between the Uf and Pf gates
+    (each a list of layers, optimized, fused and folded) and the
+    'oracles' (the parsed Uf and Pf elements to construct between
+    consecutive segments).
+    """
+    qbits, state, function, layers, measurements, options = parse(filename)
+    name = re.findall(r"^\s*(\w+)", function)[0]
+
+    # split the layers at each oracle, the elements of a layer act on
+    # distinct qbits so the oracle can go last in its layer
+    segments, oracles = [[]], list()
+    for l in layers:
+        fixed = [e for e in l if e[0].upper() not in ("UF", "PF")]
+        if fixed:
+            segments[-1].append(qsim.construct_layer(fixed, qbits, None))
+        uf = [e for e in l if e[0].upper() in ("UF", "PF")]
+        if uf:
+            oracles.append(uf)
+            segments.append(list())
+
+    for i in range(len(segments)):
+        if qsim.OPTIMIZE:
+            segments[i] = optimize(segments[i])[0]
+        segments[i] = relabel(segments[i])
+        if qsim.FUSE:
+            segments[i] = fuse(segments[i], qsim.FUSE)
+        segments[i] = fold(segments[i], qsim.FOLD)[0]
+
+    return {"qbits": qbits, "state": state, "measurements": measurements,
+            "dtype": qsim.precision(options), "name": name,
+            "segments": segments, "oracles": oracles}
+
+
+def evaluate(phi, m, rng=None):
+    """
+    Result of the measurement m (as in qstate.measure) on phi as data
+    rather than printed. dump and graph measurements give None.
+    """
+    if m[0] == "measure":
+        res = phi.sample(m[1], rng)
+        return {f"{i:0{phi.bits}b}": res[i] for i in sorted(res)}
+    if m[0] == "prob" and (isinstance(m[1], int) or m[1] == "all"):
+        top = m[1] if isinstance(m[1], int) else phi.bits
+        return phi.marginal(top).tolist()
+    if m[0] == "prob":
+        return float(phi.joint_prob(m[1]))
+    if m[0] in ("top", "threshold"):
+        index, p = phi.top(m[1]) if m[0] == "top" else phi.above(m[1])
+        return {f"{index[i]:0{phi.bits}b}": float(p[i]) for i in range(len(index))}
+    return None
+
+
+def setup(plan, seed):
+    """ keeps the compiled circuit (and seed) in each worker process """
+    global PLAN, SEED
+    PLAN = plan
+    SEED = seed
+
+
+def run(job, args):
+    """
+    Runs the circuit of PLAN with f built from the given arguments.
+    Returns a dict of the job, its arguments, the time taken and the
+    result of each measurement (a list of them per input for batches).
+    """
+    start = time.perf_counter()
+    cf = eval(f"{PLAN['name']}({args})")
+
+    circuit = list()
+    for i in range(len(PLAN["segments"])):
+        circuit += PLAN["segments"][i]
+        if i < len(PLAN["oracles"]):
+            circuit.append(qsim.construct_layer(PLAN["oracles"][i], PLAN["qbits"], cf))
+    state = PLAN["state"]
+    PHI = qsim.simulate(circuit, qsim.initial_state("statevector", state, PLAN["dtype"]))
+
+    rng = default_rng(None if SEED is None else [SEED, job])
+    result = {"job": job, "args": args}
+    for m in PLAN["measurements"]:
+        key = m if isinstance(m, str) else f"{m[0]} {m[1]}"
+        if isinstance(state, list):
+            result[key] = [evaluate(qstate(PHI.state[:, i], norm=False), m, rng) for i in range(len(state))]
+        else:
+            result[key] = evaluate(PHI, m, rng)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def sweep(filename, grid, out, workers=None):
+    """
+    Runs the circuit of the .qc file once for each argument string in
+    grid across a pool of worker processes. Results are written to out
+    (.csv for CSV, JSONL otherwise) as the jobs finish.
+
+    Returns the number of jobs run.
+    """
+    plan = compile_sweep(filename)
+    grid = list(grid)
+    with open(out, "w", newline="") as f, \
+         ProcessPoolExecutor(workers, initializer=setup, initargs=(plan, SEED)) as pool:
+        writer = None
+        jobs = [pool.submit(run, i, grid[i]) for i in range(len(grid))]
+        for job in as_completed(jobs):
+            result = job.result()
+            if out.endswith(".csv"):
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(result))
+                    writer.writeheader()
+                writer.writerow({k: v if isinstance(v, (int, float, str)) else json.dumps(v)
+                                 for k, v in result.items()})
+            else:
+                f.write(json.dumps(result) + "\n")
+            f.flush()
+    return len(grid)
+
+
+def read_grid(filename):
+    """ reads the argument sets of a grid file, one per line """
+    with open(filename) as f:
+        return [line.strip() for line in f if not re.match(r"^\s*#|^\s*$", line)]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: qsweep.py circuit.qc grid.txt results.jsonl|results.csv [workers=N] [seed=N]")
+        exit(1)
+    for i in range(4, len(sys.argv)):
+        match = re.findall(r"^workers=(\d+)", sys.argv[i].lower())
+        if len(match):
+            WORKERS = int(match[0])
+        match = re.findall(r"^seed=(\d+)", sys.argv[i].lower())
+        if len(match):
+            SEED = int(match[0])
+
+    start = time.perf_counter()
+    n = sweep(sys.argv[1], read_grid(sys.argv[2]), sys.argv[3], WORKERS)
+    print(f"Ran {n} jobs on {WORKERS or os.cpu_count()} workers in {time.perf_counter() - start:.2f} s, results in {sys.argv[3]}")
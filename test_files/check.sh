@@ -0,0 +1,40 @@
+#!/bin/sh
+# Runs the example circuits with an expected output (test_files/*.out)
+# on every backend, with and without the optimizer and the light cone,
+# and loaded back from the compiled circuit cache, and compares the
+# probabilities they print.
+#
+#   sh test_files/check.sh
+
+cd "$(dirname "$0")/.." || exit 1
+status=0
+
+check() {
+    circuit=$1; shift
+    got=$(python3 qsim.py "test_files/$circuit.qc" seed=1 "$@" 2>&1 | grep -E "^Probabilities|^  \(|^  P\[")
+    if [ "$got" = "$(cat "test_files/$circuit.out")" ]; then
+        echo "ok   $circuit $*"
+    else
+        echo "FAIL $circuit $*"
+        echo "$got" | diff "test_files/$circuit.out" - | sed "s/^/     /"
+        status=1
+    fi
+}
+
+for circuit in clifford backends; do
+    for backend in statevector factored mps "distributed workers=2" "disk block=1"; do
+        check $circuit nocache backend=$backend
+        check $circuit nocache backend=$backend noopt noprune
+    done
+    check $circuit nocache fuse=0
+done
+check clifford nocache backend=stabilizer
+check clifford nocache backend=stabilizer noopt noprune
+
+# the second run loads the circuit compiled by the first
+cache=$(mktemp -d)
+check backends cachedir=$cache
+check backends cachedir=$cache
+rm -rf "$cache"
+
+exit $status